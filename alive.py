@@ -1,39 +1,232 @@
 import os
-import flask 
-import platform
+import flask
+import math
 import time
-import random
+import heapq
 import socket
+import threading
+import concurrent.futures
 from ping3 import ping
 
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 data_file = os.path.join(basedir, 'nodes.yaml')
 
-WORDS = []
-with open(data_file, "r") as file:
-    for line in file.readlines():
-        WORDS.append(line.rstrip())
-        
+PING_TIMEOUT = 1
+PROBE_INTERVAL = float(os.getenv('ALIVE_PROBE_INTERVAL', '15'))
+RELOAD_INTERVAL = 5
+DNS_TTL = 300
+DNS_FAILURE_TTL = 30
+# Longest a probe waits for a lookup, the lookup itself keeps running
+DNS_TIMEOUT = 2
+# RTT histogram bucket bounds, in seconds
+RTT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Target list, reloaded only when nodes.yaml changes on disk.
+# Each line is "<host>" or "<host> <interval seconds>".
+targets_lock = threading.Lock()
+TARGETS = {'mtime': None, 'nodes': {}}
+
+# node -> (address or None, expiry), and node -> lookup still running
+addresses_lock = threading.Lock()
+ADDRESSES = {}
+LOOKUPS = {}
+
+# node -> probe statistics, written by the prober and read by the HTTP handlers
+stats_lock = threading.Lock()
+STATS = {}
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=32)
+# Lookups get their own threads so a hung resolver cannot hold up probes.
+resolver = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+def parse_targets(lines):
+    # Lines with an unusable interval are skipped, the rest still count.
+    nodes = {}
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        try:
+            interval = float(fields[1]) if len(fields) > 1 else PROBE_INTERVAL
+        except ValueError:
+            interval = None
+        if interval is None or not math.isfinite(interval) or interval <= 0:
+            print(f"Skipping {data_file} line {line.strip()!r}: bad interval")
+            continue
+        nodes[fields[0]] = interval
+    return nodes
+
+def load_targets():
+    # Keeps the last good targets while nodes.yaml is missing or unreadable,
+    # e.g. halfway through an editor's rename-and-write.
+    with targets_lock:
+        try:
+            mtime = os.stat(data_file).st_mtime_ns
+            if mtime != TARGETS['mtime']:
+                with open(data_file, "r") as file:
+                    TARGETS['nodes'] = parse_targets(file)
+                TARGETS['mtime'] = mtime
+        except OSError as e:
+            print(f"Could not read {data_file}: {e}")
+        return TARGETS['nodes']
+
+def resolve(node):
+    now = time.monotonic()
+    with addresses_lock:
+        cached = ADDRESSES.get(node)
+        if cached and cached[1] > now:
+            return cached[0]
+        lookup = LOOKUPS.get(node)
+        if lookup is None:
+            lookup = LOOKUPS[node] = resolver.submit(socket.gethostbyname, node)
+    try:
+        address = lookup.result(timeout=DNS_TIMEOUT)
+        expiry = now + DNS_TTL
+    except concurrent.futures.TimeoutError:
+        # Counts as unreachable for now, a later probe picks up the result.
+        return None
+    except Exception:
+        # gaierror, or anything else the lookup raised: cached as a failure
+        # for DNS_FAILURE_TTL, then looked up again.
+        address = None
+        expiry = now + DNS_FAILURE_TTL
+    with addresses_lock:
+        if LOOKUPS.get(node) is lookup:
+            del LOOKUPS[node]
+        ADDRESSES[node] = (address, expiry)
+    return address
+
+def probe(node):
+    address = resolve(node)
+    if address is None:
+        return None
+    # ping3 returns None on timeout and False on error
+    rtt = ping(address, timeout=PING_TIMEOUT, unit='ms')
+    return rtt or None
+
+def new_stats():
+    return {'rtt': None, 'last_probe': None, 'last_success': None, 'sent': 0, 'lost': 0,
+            'buckets': [0] * len(RTT_BUCKETS), 'sum': 0.0, 'count': 0, 'in_flight': False}
+
+def record(node, rtt):
+    now = time.time()
+    with stats_lock:
+        stats = STATS.setdefault(node, new_stats())
+        stats['in_flight'] = False
+        stats['sent'] += 1
+        stats['last_probe'] = now
+        stats['rtt'] = rtt
+        if rtt is None:
+            stats['lost'] += 1
+            return
+        seconds = rtt / 1000
+        stats['last_success'] = now
+        stats['sum'] += seconds
+        stats['count'] += 1
+        for i, bound in enumerate(RTT_BUCKETS):
+            if seconds <= bound:
+                stats['buckets'][i] += 1
+
+def run_probe(node):
+    try:
+        rtt = probe(node)
+    except Exception:
+        rtt = None
+    record(node, rtt)
+
+def prober():
+    # Each target is due every <interval> seconds on its own schedule, so the
+    # probe rate does not depend on how often the HTTP endpoints are read.
+    schedule = []
+    scheduled = {}
+    nodes = {}
+    next_reload = 0
+    while True:
+        now = time.monotonic()
+        try:
+            if now >= next_reload:
+                next_reload = now + RELOAD_INTERVAL
+                nodes = load_targets()
+                for node in nodes:
+                    if node not in scheduled:
+                        scheduled[node] = now
+                        heapq.heappush(schedule, (now, node))
+                for node in list(scheduled):
+                    if node not in nodes:
+                        del scheduled[node]
+                with stats_lock:
+                    for node in list(STATS):
+                        if node not in nodes:
+                            del STATS[node]
+            while schedule and schedule[0][0] <= now:
+                due, node = heapq.heappop(schedule)
+                if scheduled.get(node) != due:
+                    continue
+                with stats_lock:
+                    stats = STATS.setdefault(node, new_stats())
+                    busy = stats['in_flight']
+                    stats['in_flight'] = True
+                if not busy:
+                    executor.submit(run_probe, node)
+                scheduled[node] = now + nodes.get(node, PROBE_INTERVAL)
+                heapq.heappush(schedule, (scheduled[node], node))
+        except Exception as e:
+            # The thread must outlive any one bad round, the next one retries.
+            print(f"Prober error: {e}")
+        wake = min(schedule[0][0] if schedule else next_reload, next_reload)
+        time.sleep(max(0.0, wake - time.monotonic()))
+
+def start_prober():
+    thread = threading.Thread(target=prober, name='alive-prober', daemon=True)
+    thread.start()
+    return thread
+
+def snapshot_stats():
+    nodes = load_targets()
+    with stats_lock:
+        return [(node, dict(STATS[node], buckets=list(STATS[node]['buckets'])) if node in STATS else new_stats()) for node in nodes]
+
+load_targets()
+start_prober()
 
 app = flask.Flask(__name__)
 
 @app.route('/')
 def index():
-    Time= time.strftime("%Y-%m-%d %H:%M:%S")
     WORDS = []
-    with open(data_file, "r") as file:
-        for line in file.readlines():
-            node=line.rstrip()
-            rtt=str(int(ping(node,timeout=1, unit='ms')))
-
-            if rtt == "0":
-                pingStr=Time + " " + node + " N/A"
-            else:
-                pingStr=Time + " " + node + " " + rtt + " ms"
-                
-            WORDS.append(pingStr)
+    for node, stats in snapshot_stats():
+        probed = stats['last_probe'] or time.time()
+        Time= time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(probed))
+        rtt = str(int(stats['rtt'])) if stats['rtt'] else "0"
+
+        if rtt == "0":
+            pingStr=Time + " " + node + " N/A"
+        else:
+            pingStr=Time + " " + node + " " + rtt + " ms"
 
+        WORDS.append(pingStr)
     returnStr='\n'.join(WORDS)
     return returnStr + "\n"
-    
+
+@app.route('/metrics')
+def metrics():
+    lines = [
+        "# HELP alive_rtt_seconds ICMP round trip time.",
+        "# TYPE alive_rtt_seconds histogram",
+    ]
+    samples = snapshot_stats()
+    for node, stats in samples:
+        for bound, count in zip(RTT_BUCKETS, stats['buckets']):
+            lines.append(f'alive_rtt_seconds_bucket{{target="{node}",le="{bound}"}} {count}')
+        lines.append(f'alive_rtt_seconds_bucket{{target="{node}",le="+Inf"}} {stats["count"]}')
+        lines.append(f'alive_rtt_seconds_sum{{target="{node}"}} {stats["sum"]}')
+        lines.append(f'alive_rtt_seconds_count{{target="{node}"}} {stats["count"]}')
+    lines += ["# HELP alive_probes_total Probes sent.", "# TYPE alive_probes_total counter"]
+    lines += [f'alive_probes_total{{target="{node}"}} {stats["sent"]}' for node, stats in samples]
+    lines += ["# HELP alive_probes_lost_total Probes without a reply.", "# TYPE alive_probes_lost_total counter"]
+    lines += [f'alive_probes_lost_total{{target="{node}"}} {stats["lost"]}' for node, stats in samples]
+    lines += ["# HELP alive_last_success_timestamp_seconds Time of the last answered probe.", "# TYPE alive_last_success_timestamp_seconds gauge"]
+    lines += [f'alive_last_success_timestamp_seconds{{target="{node}"}} {stats["last_success"] or 0}' for node, stats in samples]
+    return flask.Response('\n'.join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
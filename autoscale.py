@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+import os
+import re
+import csv
+import math
+import time
+import datetime
+import collections
+import urllib.request
+import concurrent.futures
+from haproxy_runtime import HAPROXY_BACKEND, proxy_hosts, proxy_transport, dev_addresses
+from tracing import span, traced
+
+AUTOSCALE_MIN = int(os.getenv('AUTOSCALE_MIN', '1'))
+AUTOSCALE_MAX = int(os.getenv('AUTOSCALE_MAX', '10'))
+AUTOSCALE_INTERVAL = int(os.getenv('AUTOSCALE_INTERVAL', '30'))
+# Per dev server targets
+TARGET_CPU = float(os.getenv('AUTOSCALE_TARGET_CPU', '0.6'))
+TARGET_RATE = float(os.getenv('AUTOSCALE_TARGET_RATE', '50'))
+MAX_QUEUE = int(os.getenv('AUTOSCALE_MAX_QUEUE', '10'))
+# Ratios this close to 1 do not move the count
+TOLERANCE = float(os.getenv('AUTOSCALE_TOLERANCE', '0.1'))
+UP_COOLDOWN = int(os.getenv('AUTOSCALE_UP_COOLDOWN', '60'))
+DOWN_COOLDOWN = int(os.getenv('AUTOSCALE_DOWN_COOLDOWN', '300'))
+# Scale-down follows the highest recommendation seen over this window
+DOWN_WINDOW = int(os.getenv('AUTOSCALE_DOWN_WINDOW', '300'))
+# "{address}" is replaced by a dev server's internal IP
+NODE_EXPORTER_URL = os.getenv('AUTOSCALE_NODE_EXPORTER_URL', 'http://{address}:9100/metrics')
+# HAProxy CSV stats over HTTP, e.g. http://proxy:8404/stats;csv. Unset means the
+# runtime API on the inventory proxies.
+HAPROXY_STATS_URL = os.getenv('AUTOSCALE_HAPROXY_STATS_URL')
+HTTP_TIMEOUT = 5
+
+CPU_SAMPLE = re.compile(r'^node_cpu_seconds_total\{([^}]*)\}\s+(\S+)', re.M)
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{timestamp} {message}")
+
+def fetch(url):
+    with span('autoscale fetch', 'api', url=url):
+        with urllib.request.urlopen(url, timeout=HTTP_TIMEOUT) as response:
+            return response.read().decode()
+
+def parse_cpu_seconds(text):
+    # (idle seconds, total seconds) summed over every CPU
+    idle = total = 0.0
+    for labels, value in CPU_SAMPLE.findall(text):
+        seconds = float(value)
+        total += seconds
+        if 'mode="idle"' in labels:
+            idle += seconds
+    return idle, total
+
+def parse_haproxy_csv(text, backend=HAPROXY_BACKEND):
+    # Request rate and queued requests of the backend, from "show stat" CSV.
+    lines = text.strip().splitlines()
+    if not lines:
+        return None
+    lines[0] = lines[0].lstrip('# ')
+    for row in csv.DictReader(lines):
+        if row.get('pxname') == backend and row.get('svname') == 'BACKEND':
+            return {'rate': float(row.get('rate') or 0), 'queue': int(row.get('qcur') or 0)}
+    return None
+
+class SignalCollector:
+    def __init__(self, node_exporter_url=NODE_EXPORTER_URL, haproxy_stats_url=HAPROXY_STATS_URL):
+        self.node_exporter_url = node_exporter_url
+        self.haproxy_stats_url = haproxy_stats_url
+        # address -> last (idle, total), CPU use is the delta between two scrapes
+        self.cpu_samples = {}
+
+    def cpu_usage(self, address):
+        try:
+            sample = parse_cpu_seconds(fetch(self.node_exporter_url.format(address=address)))
+        except Exception as e:
+            log(f"node_exporter on {address}: {e}")
+            return None
+        previous = self.cpu_samples.get(address)
+        self.cpu_samples[address] = sample
+        if previous is None or sample[1] <= previous[1]:
+            return None
+        return 1 - (sample[0] - previous[0]) / (sample[1] - previous[1])
+
+    def haproxy_stats(self, hosts):
+        if self.haproxy_stats_url:
+            try:
+                return parse_haproxy_csv(fetch(self.haproxy_stats_url))
+            except Exception as e:
+                log(f"HAProxy stats: {e}")
+                return None
+        # Active and standby proxy both report, the busier one carries the traffic.
+        best = None
+        for name, hostvars in proxy_hosts(hosts).items():
+            try:
+                stats = parse_haproxy_csv(proxy_transport(hostvars).send([f'show stat {HAPROXY_BACKEND} 2 -1']))
+            except Exception as e:
+                log(f"HAProxy stats on {name}: {e}")
+                continue
+            if stats and (best is None or stats['rate'] > best['rate']):
+                best = stats
+        return best
+
+    @traced('collect signals')
+    def collect(self, hosts):
+        addresses = dev_addresses(hosts)
+        forget = set(self.cpu_samples) - set(addresses)
+        for address in forget:
+            del self.cpu_samples[address]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(addresses))) as executor:
+            usage = [value for value in executor.map(self.cpu_usage, addresses) if value is not None]
+        stats = self.haproxy_stats(hosts)
+        return {
+            'servers': len(addresses),
+            'cpu': sum(usage) / len(usage) if usage else None,
+            'rate': stats['rate'] if stats else None,
+            'queue': stats['queue'] if stats else None,
+        }
+
+class Autoscaler:
+    def __init__(self, minimum=AUTOSCALE_MIN, maximum=AUTOSCALE_MAX, up_cooldown=UP_COOLDOWN, down_cooldown=DOWN_COOLDOWN,
+                 down_window=DOWN_WINDOW, target_cpu=TARGET_CPU, target_rate=TARGET_RATE, max_queue=MAX_QUEUE, tolerance=TOLERANCE):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.down_window = down_window
+        self.target_cpu = target_cpu
+        self.target_rate = target_rate
+        self.max_queue = max_queue
+        self.tolerance = tolerance
+        self.last_change = None
+        self.started = None
+        # (time, recommendation) over the scale-down window
+        self.recommendations = collections.deque()
+
+    def scaled(self, current, ratio):
+        if abs(ratio - 1) <= self.tolerance:
+            return current
+        return math.ceil(current * ratio)
+
+    def recommend(self, current, signals):
+        # Highest count any signal asks for. No signal at all keeps the count.
+        counts = []
+        if signals.get('cpu') is not None:
+            counts.append(self.scaled(current, signals['cpu'] / self.target_cpu))
+        if signals.get('rate') is not None:
+            counts.append(self.scaled(current, signals['rate'] / (self.target_rate * max(current, 1))))
+        if signals.get('queue') is not None and signals['queue'] > self.max_queue:
+            counts.append(current + 1)
+        if not counts:
+            return current
+        return max(counts)
+
+    def decide(self, current, signals, now=None):
+        now = time.monotonic() if now is None else now
+        if self.started is None:
+            self.started = now
+        clamped = min(max(current, self.minimum), self.maximum)
+        if clamped != current:
+            # Outside the bounds, e.g. after they were changed: fix it right away.
+            self.last_change = now
+            return clamped
+        recommendation = min(max(self.recommend(current, signals), self.minimum), self.maximum)
+        self.recommendations.append((now, recommendation))
+        while self.recommendations and self.recommendations[0][0] < now - self.down_window:
+            self.recommendations.popleft()
+        since_change = None if self.last_change is None else now - self.last_change
+        if recommendation > current:
+            if since_change is not None and since_change < self.up_cooldown:
+                return current
+            self.last_change = now
+            return recommendation
+        # Only scale down if the whole window agrees, and one server at a time.
+        stable = max(count for _, count in self.recommendations)
+        window_full = now - self.started >= self.down_window
+        if stable < current and window_full and (since_change is None or since_change >= self.down_cooldown):
+            self.last_change = now
+            return current - 1
+        return current
+
+def read_servers_conf(file_path):
+    # "3" pins the count, "auto" or "auto <min> <max>" hands it to the autoscaler.
+    with open(file_path, 'r') as file:
+        fields = file.read().split()
+    if fields and fields[0] == 'auto':
+        bounds = [int(field) for field in fields[1:3]]
+        return 'auto', (bounds + [AUTOSCALE_MIN, AUTOSCALE_MAX][len(bounds):])
+    if len(fields) != 1:
+        raise ValueError(f"expected a number or 'auto' in {file_path}")
+    return 'manual', int(fields[0])
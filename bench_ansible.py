@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import datetime
+import tempfile
+import subprocess
+try:
+    import gen_config as configfiles
+except ImportError:
+    import configfiles
+
+# Same shape as site.yaml: a play over every host, a second play that needs
+# facts again, and per-host dev server work of uneven length.
+PLAYBOOK = """---
+- hosts: all
+  tasks:
+    - name: write a marker
+      copy:
+        content: "{{ inventory_hostname }}"
+        dest: "{{ workdir }}/{{ inventory_hostname }}.marker"
+    - name: run a command
+      command: "true"
+
+- hosts: all
+  tasks:
+    - name: use a fact
+      debug:
+        msg: "{{ ansible_hostname }}"
+      changed_when: false
+
+- hosts: devservers
+  strategy: "{{ devservers_strategy | default('free') }}"
+  tasks:
+    - name: uneven work
+      command: "sleep {{ (groups['devservers'].index(inventory_hostname) % 3) * 0.5 }}"
+    - name: second step
+      command: "true"
+"""
+
+DEFAULT_CONFIG = "[defaults]\nhost_key_checking = False\n"
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{timestamp} {message}", file=sys.stderr)
+
+def write_inventory(path, host_count, connection, ssh_host, ssh_user, key_path):
+    # Stand-in hosts: every name points at this machine, either through the
+    # local connection plugin or through sshd on ssh_host.
+    if connection == 'local':
+        host_vars = f"ansible_connection=local ansible_python_interpreter={sys.executable}"
+    else:
+        host_vars = f"ansible_host={ssh_host} ansible_user={ssh_user} ansible_ssh_private_key_file={key_path}"
+    lines = ["[bastion]\n", f"bench_bastion {host_vars}\n", "\n[devservers]\n"]
+    for index in range(1, host_count):
+        lines.append(f"bench_dev{index} {host_vars}\n")
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+def run_profile(workdir, config, strategy, runs):
+    config_path = os.path.join(workdir, 'ansible.cfg')
+    with open(config_path, 'w') as f:
+        f.write(config)
+    env = dict(os.environ, ANSIBLE_CONFIG=config_path)
+    command = ['ansible-playbook', '-i', 'hosts', 'bench.yaml', '-e', f'workdir={workdir}', '-e', f'devservers_strategy={strategy}']
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.run(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        elapsed = time.perf_counter() - start
+        if process.returncode != 0:
+            raise Exception(f"ansible-playbook failed: {process.stderr.decode()}")
+        timings.append(round(elapsed, 3))
+    return {'cold_s': timings[0], 'warm_s': timings[1:], 'best_s': min(timings)}
+
+def run_benchmark(host_count, runs, connection, ssh_host, ssh_user, key_path):
+    tuned_config = configfiles.render_ansible_config('bench', {}, 'bench_bastion', key_path, host_count)
+    profiles = {
+        'default': (DEFAULT_CONFIG, 'linear'),
+        'tuned': (tuned_config, 'free'),
+    }
+    results = {}
+    for name, (config, strategy) in profiles.items():
+        # Fresh directory per profile so the tuned fact cache starts cold.
+        with tempfile.TemporaryDirectory() as workdir:
+            write_inventory(os.path.join(workdir, 'hosts'), host_count, connection, ssh_host, ssh_user, key_path)
+            with open(os.path.join(workdir, 'bench.yaml'), 'w') as f:
+                f.write(PLAYBOOK)
+            results[name] = run_profile(workdir, config, strategy, runs)
+        log(f"{name:8} cold {results[name]['cold_s']}s  warm {results[name]['warm_s']}  best {results[name]['best_s']}s")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare default Ansible settings with the generated ansible.cfg profile.')
+    parser.add_argument('--hosts', type=int, default=12, help='Number of stand-in hosts')
+    parser.add_argument('--runs', type=int, default=3, help='Playbook runs per profile, the first one is cold')
+    parser.add_argument('--connection', choices=['local', 'ssh'], default='local')
+    parser.add_argument('--ssh-host', default='127.0.0.1')
+    parser.add_argument('--ssh-user', default=os.getenv('USER', 'ubuntu'))
+    parser.add_argument('--key', default=os.path.expanduser('~/.ssh/id_rsa'))
+    parser.add_argument('--output', default='bench_ansible.json')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.hosts, max(args.runs, 2), args.connection, args.ssh_host, args.ssh_user, args.key)
+    default, tuned = results['default'], results['tuned']
+    log(f"Speedup cold {default['cold_s'] / tuned['cold_s']:.2f}x, best {default['best_s'] / tuned['best_s']:.2f}x")
+    run = {
+        'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'hosts': args.hosts,
+        'connection': args.connection,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(run, f, indent=2, sort_keys=True)
+    log(f"Stored results in {args.output}")
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import ipaddress
+import datetime
+import tempfile
+import contextlib
+import collections
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+# Keep the scripts away from the real trace file, ~/.ssh and the project's state files.
+workdir = tempfile.mkdtemp(prefix='bench_orchestration_')
+os.environ['HOME'] = workdir
+os.environ.setdefault('TRACE_FILE', '')
+# The deploy's own /24 pool stops at 29 addresses, the benchmark gives its
+# tags a subnet big enough for the fleet sizes it measures.
+os.environ.update(SUBNET_CIDR='10.10.0.0/16', SUBNET_POOL_START='10.10.0.2', SUBNET_POOL_END='10.10.255.254')
+sys.path.insert(0, basedir)
+
+import openstack
+import fake_openstack
+import operate
+import cleanup
+from multideploy import Driver, load_deploy, target_directory
+try:
+    import gen_config as configfiles
+except ImportError:
+    import configfiles
+
+TAG = 'bench'
+# The pool holds the bastion, both HAProxies, the VIP and the dev servers,
+# and scale-up doubles the dev servers.
+SUBNET_POOL = int(ipaddress.ip_address(os.environ['SUBNET_POOL_END'])) - int(ipaddress.ip_address(os.environ['SUBNET_POOL_START'])) + 1
+MAX_SIZE = (SUBNET_POOL - 4) // 2
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{timestamp} {message}", file=sys.stderr)
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def measure(cloud, function):
+    cloud.reset_calls()
+    start = time.perf_counter()
+    with quiet():
+        function()
+    elapsed = time.perf_counter() - start
+    calls = dict(cloud.calls)
+    return {'wall_s': round(elapsed, 3), 'api_calls': sum(calls.values()), 'calls': calls}
+
+def write_credentials():
+    rc_file = os.path.join(workdir, 'openrc')
+    key_path = os.path.join(workdir, 'id_rsa')
+    for path, content in ((rc_file, 'OS_AUTH_URL=http://fake\n'), (key_path, ''), (key_path + '.pub', 'ssh-rsa AAAA bench\n')):
+        with open(path, 'w') as f:
+            f.write(content)
+    return rc_file, key_path
+
+def run_size(deploy, size, latency, boot_delay, delete_delay, failure_rate, seed):
+    cloud = fake_openstack.FakeCloud(latency=latency, boot_delay=boot_delay, delete_delay=delete_delay, failure_rate=failure_rate, seed=seed)
+    openstack.connect = cloud.connect
+    rc_file, key_path = write_credentials()
+    deploy.DEV_SERVERS = size
+    conn = cloud.connect()
+    results = {}
+
+    def scale(required):
+        dev_servers = operate.list_dev_servers(conn, TAG)
+        network, subnet, router, security_group, keypair_name = operate.get_network_parameters(conn, TAG)
+        created = operate.manage_dev_servers(conn, dev_servers.values(), TAG, keypair_name, network, security_group, required)
+        operate.wait_for_new_servers(conn, created)
+
+    def configs():
+        internal_ips = configfiles.fetch_internal_ips(conn, TAG)
+        configfiles.render_host_file(internal_ips, configfiles.read_fip_file('servers_fip'), TAG, key_path)
+
+    results['deploy'] = measure(cloud, lambda: deploy.main(rc_file, TAG, key_path))
+    # Nothing changed, so this should stop after the converged check.
+    results['redeploy'] = measure(cloud, lambda: deploy.main(rc_file, TAG, key_path))
+    results['configs'] = measure(cloud, configs)
+    results['scale-up'] = measure(cloud, lambda: scale(size * 2))
+    results['scale-down'] = measure(cloud, lambda: scale(size))
+    results['cleanup'] = measure(cloud, lambda: cleanup.cleanup_instances(conn, TAG))
+    # Floating IPs stay with the project on purpose, see FloatingIPPool.
+    leftovers = {kind: len(resources) for kind, resources in cloud.resources.items() if kind not in ('network', 'ip') and resources}
+    if len(cloud.resources['network']) > 1 or leftovers:
+        log(f"Cleanup left resources behind: {leftovers}, networks {len(cloud.resources['network'])}")
+    return results
+
+def run_tags(tags, size, latency, boot_delay, seed):
+    # Several tags of one project deployed by multideploy at once, with free
+    # floating IPs left over from earlier cleanups for all of them to pick.
+    cloud = fake_openstack.FakeCloud(latency=latency, boot_delay=boot_delay, seed=seed)
+    openstack.connect = cloud.connect
+    _, key_path = write_credentials()
+    conn = cloud.connect()
+    external = conn.network.find_network('ext-net')
+    for _ in range(4 * len(tags)):
+        conn.network.create_ip(floating_network_id=external.id)
+    output = os.path.join(workdir, 'tags')
+    driver = Driver('deploy', tags, key_path, output, rate=1000, burst=1000, dev_servers=size, configure=False)
+    result = measure(cloud, driver.run)
+    # Every public server and VIP of every tag needs an address of its own.
+    assigned = collections.defaultdict(list)
+    for tag_name in tags:
+        directory = target_directory(output, None, tag_name)
+        addresses = list(configfiles.read_fip_file(os.path.join(directory, 'servers_fip')).values())
+        with open(os.path.join(directory, 'vip_address')) as f:
+            addresses.append(f.read().strip())
+        for address in addresses:
+            assigned[address].append(tag_name)
+    result['shared_addresses'] = {address: names for address, names in assigned.items() if len(names) > 1}
+    result['attached_addresses'] = len([floating_ip for floating_ip in cloud.resources['ip'].values() if floating_ip.port_id])
+    return result
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, scenarios in results.items():
+        for scenario, result in scenarios.items():
+            previous = baseline.get('results', {}).get(size, {}).get(scenario)
+            if not previous:
+                continue
+            if result['api_calls'] > previous['api_calls']:
+                regressions.append(f"{scenario} x{size}: {result['api_calls']} API calls vs baseline {previous['api_calls']}")
+            if result['wall_s'] > previous['wall_s'] * (1 + tolerance):
+                regressions.append(f"{scenario} x{size}: {result['wall_s']}s vs baseline {previous['wall_s']}s")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time deploy, scale and cleanup against an in-memory OpenStack.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 50, 500], help=f'Dev server counts up to {MAX_SIZE}, scale-up doubles them inside the subnet allocation pool')
+    parser.add_argument('--tags', type=int, default=2, help='Tags deployed at once through multideploy, 0 to skip')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds per API call')
+    parser.add_argument('--boot-delay', type=float, default=1.0)
+    parser.add_argument('--delete-delay', type=float, default=0.5)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of mutating calls that fail')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_orchestration.json')
+    parser.add_argument('--baseline', help='Stored run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Allowed relative wall time regression')
+    args = parser.parse_args()
+    if not all(0 < size <= MAX_SIZE for size in args.sizes):
+        parser.error(f"--sizes must be between 1 and {MAX_SIZE}, the subnet allocation pool has {SUBNET_POOL} addresses")
+
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    os.chdir(workdir)
+    deploy = load_deploy()
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = run_size(deploy, size, args.latency, args.boot_delay, args.delete_delay, args.failure_rate, args.seed)
+        for scenario, result in results[str(size)].items():
+            log(f"{size:>5} dev servers  {scenario:10}  {result['wall_s']:>8}s  {result['api_calls']:>6} API calls")
+    tags_result = None
+    if args.tags:
+        tags_result = run_tags([f"{TAG}{i}" for i in range(1, args.tags + 1)], min(args.sizes), args.latency, args.boot_delay, args.seed)
+        log(f"{args.tags:>5} tags at once   deploy      {tags_result['wall_s']:>8}s  {tags_result['api_calls']:>6} API calls")
+    run = {
+        'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'latency': args.latency,
+        'boot_delay': args.boot_delay,
+        'delete_delay': args.delete_delay,
+        'failure_rate': args.failure_rate,
+        'results': results,
+        'tags': tags_result,
+    }
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2, sort_keys=True)
+    log(f"Stored results in {output}")
+    if tags_result and tags_result['shared_addresses']:
+        log(f"Floating IPs assigned to more than one tag: {tags_result['shared_addresses']}")
+        sys.exit(1)
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            log(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import datetime
+import threading
+import subprocess
+import http.client
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+# module:app -> request path
+APPS = {
+    'service:app': '/',
+    'application2:app': '/',
+    'assignment2:app': '/',
+    'main:app': '/add?A=1&B=2',
+}
+
+# name -> extra gunicorn arguments
+CONFIGS = {
+    'sync-1': ['--worker-class', 'sync', '--workers', '1'],
+    'sync-4': ['--worker-class', 'sync', '--workers', '4'],
+    'gthread-2x4': ['--worker-class', 'gthread', '--workers', '2', '--threads', '4'],
+    'gthread-4x8': ['--worker-class', 'gthread', '--workers', '4', '--threads', '8'],
+}
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{timestamp} {message}", file=sys.stderr)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def start_gunicorn(app, config_args, port):
+    command = [sys.executable, '-m', 'gunicorn', '--chdir', basedir, '--bind', f'127.0.0.1:{port}', '--log-level', 'warning'] + config_args + [app]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if not wait_for_port(port):
+        process.kill()
+        raise Exception(f"gunicorn did not start for {app}: {process.stderr.read().decode()}")
+    return process
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def generate_load(port, path, concurrency, duration):
+    # Closed-loop load: every client thread keeps one connection and sends the
+    # next request as soon as the previous answer arrives.
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        local_latencies = []
+        local_errors = 0
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    local_errors += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                connection.close()
+                continue
+            local_latencies.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+def run_benchmarks(apps, configs, concurrency, duration, warmup):
+    results = {}
+    for app in apps:
+        for config in configs:
+            port = free_port()
+            process = start_gunicorn(app, CONFIGS[config], port)
+            try:
+                generate_load(port, APPS[app], concurrency, warmup)
+                result = generate_load(port, APPS[app], concurrency, duration)
+            finally:
+                process.terminate()
+                process.wait()
+            results[f"{app} {config}"] = result
+            log(f"{app:18} {config:12} {result['rps']:>9} req/s  p50 {result['p50_ms']} ms  p95 {result['p95_ms']} ms  p99 {result['p99_ms']} ms  errors {result['errors']}")
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous or not previous.get('rps') or result['p99_ms'] is None:
+            continue
+        if result['rps'] < previous['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['rps']} req/s vs baseline {previous['rps']}")
+        if previous.get('p99_ms') and result['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']} ms vs baseline {previous['p99_ms']}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the Flask services under several gunicorn configurations.')
+    parser.add_argument('--apps', nargs='+', default=list(APPS), choices=list(APPS))
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--output', default='bench_services.json', help='Where to store this run')
+    parser.add_argument('--baseline', help='Stored run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed relative regression')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.apps, args.configs, args.concurrency, args.duration, args.warmup)
+    run = {
+        'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(run, f, indent=2, sort_keys=True)
+    log(f"Stored results in {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            log(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
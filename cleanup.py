@@ -1,167 +1,227 @@
 #!/usr/bin/python3
 import openstack
 import os
+import time
 import argparse
 import datetime
+import shutil
+import functools
+import concurrent.futures
 import openstack.exceptions
-import subprocess
-from contextlib import contextmanager
+from snapshot import ResourceSnapshot
+from fippool import FloatingIPPool
+from tracing import span, traced, trace_connection
+import state
+import token_cache
+
+CLEANUP_WORKERS = int(os.getenv('CLEANUP_WORKERS', '8'))
 
 def connect_to_openstack():
-    return openstack.connect(
-        auth_url=os.getenv('OS_AUTH_URL'),
-        project_name=os.getenv('OS_PROJECT_NAME'),
-        username=os.getenv('OS_USERNAME'),
-        password=os.getenv('OS_PASSWORD'),
-        user_domain_name=os.getenv('OS_USER_DOMAIN_NAME'),
-        project_domain_name=os.getenv('OS_PROJECT_DOMAIN_NAME')
-    )
-
-def delete_servers(conn, server_names, dev_server, devservers_count):
-    for server_name in server_names:
-        try:
-            server = conn.compute.find_server(server_name)
-            if server:
-                # Iterate over all addresses associated with the server
-                for network_name, address_list in server.addresses.items():
-                    for address in address_list:
-                        if address['OS-EXT-IPS:type'] == 'floating':
-                            floating_ip = address['addr']
-                            floating_ip_obj = conn.network.find_ip(floating_ip)
-                            if floating_ip_obj:
-                                conn.network.delete_ip(floating_ip_obj)
-                                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, Releasing floating IP {floating_ip} associated with {server_name}")
-                            else:
-                                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, Floating IP {floating_ip} not found")
-                
-                # Delete the server after releasing the floating IP
-                conn.compute.delete_server(server)
-                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, Releasing server {server_name}")
-            else:
-                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, {server_name} not found")
-        except openstack.exceptions.ResourceNotFound:
-            print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, {server_name} not found")
+    with span('connect', 'api'):
+        return trace_connection(token_cache.connect(
+            auth_url=os.getenv('OS_AUTH_URL'),
+            project_name=os.getenv('OS_PROJECT_NAME'),
+            username=os.getenv('OS_USERNAME'),
+            password=os.getenv('OS_PASSWORD'),
+            user_domain_name=os.getenv('OS_USER_DOMAIN_NAME'),
+            project_domain_name=os.getenv('OS_PROJECT_DOMAIN_NAME')
+        ))
 
-    # Delete dev servers
-    for i in range(1, devservers_count + 1):
-        devserver_name = f"{dev_server}{i}"
-        try:
-            server = conn.compute.find_server(devserver_name)
+@traced()
+def delete_server(conn, snapshot, fip_pool, server):
+    server_name = server.name
+    try:
+        # Iterate over all addresses associated with the server
+        for network_name, address_list in server.addresses.items():
+            for address in address_list:
+                if address['OS-EXT-IPS:type'] == 'floating':
+                    floating_ip = address['addr']
+                    floating_ip_obj = snapshot.ip_for_address(floating_ip)
+                    if floating_ip_obj and fip_pool:
+                        fip_pool.release(floating_ip_obj)
+                        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, Returning floating IP {floating_ip} associated with {server_name} to the pool")
+                    elif floating_ip_obj:
+                        conn.network.delete_ip(floating_ip_obj)
+                        snapshot.remove('ip', floating_ip_obj)
+                        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, Releasing floating IP {floating_ip} associated with {server_name}")
+                    else:
+                        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, Floating IP {floating_ip} not found")
+        
+        # Delete the server after releasing the floating IP
+        conn.compute.delete_server(server)
+        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, Releasing server {server_name}")
+    except openstack.exceptions.ResourceNotFound:
+        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, {server_name} not found")
+
+@traced(kind='wait')
+def wait_for_servers_deleted(conn, snapshot, tag_name, server_ids, timeout=600, max_delay=10):
+    # Nova deletes asynchronously; ports, subnet and network conflict until the
+    # servers are really gone. One filtered list per tick covers every server.
+    pending = set(server_ids)
+    deadline = time.monotonic() + timeout
+    delay = 1
+    while pending:
+        remaining = {server.id for server in conn.compute.servers(name=f"^{tag_name}_")}
+        for server_id in pending - remaining:
+            server = snapshot.get_by_id('server', server_id)
             if server:
-                # Iterate over all addresses associated with the server
-                for network_name, address_list in server.addresses.items():
-                    for address in address_list:
-                        if address['OS-EXT-IPS:type'] == 'floating':
-                            floating_ip = address['addr']
-                            floating_ip_obj = conn.network.find_ip(floating_ip)
-                            if floating_ip_obj:
-                                conn.network.delete_ip(floating_ip_obj)
-                                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, Releasing floating IP {floating_ip} associated with {devserver_name}")
-                            else:
-                                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, Floating IP {floating_ip} not found")
-                
-                # Delete the server after releasing the floating IP
-                conn.compute.delete_server(server)
-                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, Releasing server {devserver_name}")
-            else:
-                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, {devserver_name} not found")
-        except openstack.exceptions.ResourceNotFound:
-            print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, {devserver_name} not found")
+                snapshot.remove('server', server)
+        pending &= remaining
+        if not pending:
+            break
+        if time.monotonic() >= deadline:
+            print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Timed out waiting for {len(pending)} servers to be deleted")
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+    print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Servers deleted")
 
+@traced()
+def run_teardown(steps, max_workers=CLEANUP_WORKERS):
+    # steps maps a name to (function, dependencies). Every step whose
+    # dependencies have finished runs at once; a failed step still counts as
+    # finished so the rest of the teardown is attempted, as before.
+    futures = {}
+    done = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(done) < len(steps):
+            for name, (function, dependencies) in steps.items():
+                if name not in futures and all(dependency in done for dependency in dependencies):
+                    futures[name] = executor.submit(function)
+            running = {future: name for name, future in futures.items() if name not in done}
+            if not running:
+                raise Exception(f"Unresolvable teardown dependencies: {sorted(set(steps) - done)}")
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Step {running[future]} failed: {e}")
+                done.add(running[future])
 
-def delete_ports(conn, port_names):
+@traced()
+def delete_ports(conn, snapshot, port_names):
     for port_name in port_names:
         try:
-            port = conn.network.find_port(port_name)
+            port = snapshot.get('port', port_name)
             if port:
                 conn.network.delete_port(port)
+                snapshot.remove('port', port)
                 print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Removing {port_name}")
             else:
                 print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},{port_name} not found")
         except openstack.exceptions.ResourceNotFound:
             print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},{port_name} not found")
 
-def delete_subnets(conn, subnet_names):
+@traced()
+def delete_subnets(conn, snapshot, subnet_names):
     for subnet_name in subnet_names:
-        subnet = conn.network.find_subnet(subnet_name)
+        subnet = snapshot.get('subnet', subnet_name)
         if subnet:
-            # Get all ports and filter those associated with the subnet
-            all_ports = conn.network.ports()
-            ports = [port for port in all_ports if any(fixed_ip['subnet_id'] == subnet.id for fixed_ip in port.fixed_ips)]
+            # Ports still holding an address on the subnet, straight from the snapshot index
+            ports = snapshot.ports_on_subnet(subnet.id)
             for port in ports:
                 try:
                     conn.network.delete_port(port)
+                    snapshot.remove('port', port)
                     print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Detached port {port.name} associated with subnet {subnet_name}")
                 except openstack.exceptions.ResourceNotFound:
+                    # Already gone with its server
+                    snapshot.remove('port', port)
                     print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Port {port.name} not found")
 
             # Delete subnet
             try:
                 conn.network.delete_subnet(subnet)
+                snapshot.remove('subnet', subnet)
                 print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Removing subnet {subnet_name}")
             except openstack.exceptions.ConflictException as e:
                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Unable to delete subnet {subnet_name}: {e}")
         else:
             print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Subnet {subnet_name} not found")
 
-def delete_router(conn, router_name):
+@traced()
+def delete_router(conn, snapshot, router_name):
     try:
-        router = conn.network.find_router(router_name)
+        router = snapshot.get('router', router_name)
         if router:
             # Get all ports and filter those associated with the router
-            all_ports = conn.network.ports(device_id=router.id)
+            all_ports = snapshot.ports_for_device(router.id)
             for port in all_ports:
                 conn.network.remove_interface_from_router(router, port_id=port.id)
+                snapshot.remove('port', port)
                 print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Removed interface {port.id} from router {router_name}")
             conn.network.delete_router(router)
+            snapshot.remove('router', router)
             print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}Removing {router_name}")
         else:
             print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},{router_name} not found")
     except openstack.exceptions.ResourceNotFound:
         print(f"{router_name} not found")
 
-def delete_network(conn, network_name):
+@traced()
+def delete_network(conn, snapshot, network_name):
     try:
-        network = conn.network.find_network(network_name)
+        network = snapshot.get('network', network_name)
         if network:
             conn.network.delete_network(network)
+            snapshot.remove('network', network)
             print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}Removing {network_name}")
         else:
             print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},{network_name} not found")
     except openstack.exceptions.ResourceNotFound:
         print(f"{network_name} not found")
 
-def delete_security_group(conn, security_group_name):
+@traced()
+def delete_security_group(conn, snapshot, security_group_name):
     try:
-        security_group = conn.network.find_security_group(security_group_name)
+        security_group = snapshot.get('security_group', security_group_name)
         if security_group:
             conn.network.delete_security_group(security_group)
+            snapshot.remove('security_group', security_group)
             print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Removing {security_group_name}")
         else:
             print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},{security_group_name} not found")
     except openstack.exceptions.ResourceNotFound:
         print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},{security_group_name} not found")
 
+@traced()
 def delete_keypair(conn, keypair_name):
     try:
-        subprocess.check_output(['openstack', 'keypair', 'delete', keypair_name])
+        conn.compute.delete_keypair(keypair_name, ignore_missing=False)
         print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Removing key pair {keypair_name}")
-    except subprocess.CalledProcessError as e:
-        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Error deleting key pair {keypair_name}: {str(e)}")
-
-def delete_files(tag_name):
-    # List of files to delete
-    config_file = os.path.expanduser("~/.ssh/config")
-    known_hosts_file = os.path.expanduser("~/.ssh/known_hosts")
-    files_to_delete = ['servers_fip', 'vip_address', 'hosts','ansible.cfg', config_file,known_hosts_file]
+    except openstack.exceptions.ResourceNotFound:
+        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Key pair {keypair_name} not found")
+
+def leftovers(snapshot, tag_name):
+    # What the snapshot still holds of the tag once the teardown steps ran.
+    return [f"{kind} {resource.name}" for kind in ('server', 'port', 'router', 'subnet', 'network', 'security_group')
+            for resource in snapshot.with_prefix(kind, f"{tag_name}_")]
+
+@traced(kind='file')
+def delete_files(tag_name, directory='', snapshot=None):
+    # List of files to delete. A per-tag directory from multideploy.py also
+    # stands in for the home directory the SSH config went to.
+    # With a snapshot, the files and the state record are kept while any of
+    # the tag's resources are left, so the operator can still reach them.
+    left = leftovers(snapshot, tag_name) if snapshot else []
+    if left:
+        raise Exception(f"Keeping the local files of {tag_name}, still present: {', '.join(left)}")
+    home = directory or os.path.expanduser("~")
+    config_file = os.path.join(home, ".ssh", "config")
+    known_hosts_file = os.path.join(home, ".ssh", "known_hosts")
+    files_to_delete = [os.path.join(directory, name) for name in ['servers_fip', 'vip_address', 'hosts','ansible.cfg', '.ansible_hosts_state.json', '.inventory_cache.json']] + [config_file,known_hosts_file]
     for file_name in files_to_delete:
         try:
             os.remove(file_name)
             print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Removing {file_name}")
         except FileNotFoundError:
             print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},{file_name} not found")
+    shutil.rmtree(os.path.join(directory, '.ansible_facts'), ignore_errors=True)
+    state.forget(tag_name, os.path.join(directory, state.STATE_FILE))
 
-def cleanup_instances(conn, tag_name):
+@traced('cleanup')
+def cleanup_instances(conn, tag_name, release_floating_ips=False, directory=''):
     network_name = f"{tag_name}_network"
     subnet_name = f"{tag_name}_subnet"
     keypair_name = f"{tag_name}_key"
@@ -171,48 +231,57 @@ def cleanup_instances(conn, tag_name):
     haproxy_server2 = f"{tag_name}_HAproxy2"
     bastion_server = f"{tag_name}_bastion"
     dev_server = f"{tag_name}_dev"
-    devservers_count = len(list(conn.compute.servers(name=dev_server)))
     vip_port = f"{tag_name}_vip_port"
+    with span('snapshot'):
+        snapshot = ResourceSnapshot(conn, tag_name)
+    dev_servers = sorted({server.name for server in snapshot.with_prefix('server', dev_server)})
+    # Floating IPs stay allocated to the project for the next deploy unless asked to release them.
+    fip_pool = None if release_floating_ips else FloatingIPPool(conn, snapshot)
 
     print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},$> cleanup {tag_name}")
     print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')},Cleaning up {tag_name} using myRC")
-    delete_servers(conn, [bastion_server, haproxy_server, haproxy_server2], dev_server, devservers_count)
-    delete_ports(conn, [vip_port])
-    delete_router(conn, router_name)
-    delete_subnets(conn, [subnet_name])
-    delete_network(conn, network_name)
-    delete_security_group(conn, security_group_name)
-    delete_keypair(conn, keypair_name)
-    delete_files(tag_name)
-
-    instances = conn.compute.servers()
-    instance_names = set()
-    for instance in instances:
-        if tag_name in instance.name:
-            if instance.name in instance_names:
-                print(f"Duplicate instance found: {instance.name}. Removing it.")
-                conn.compute.delete_server(instance)
-            else:
-                instance_names.add(instance.name)
+    servers = []
+    for server_name in [bastion_server, haproxy_server, haproxy_server2] + dev_servers:
+        named = snapshot.named('server', server_name)
+        if not named:
+            print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, {server_name} not found")
+        if len(named) > 1:
+            print(f"Duplicate instance found: {server_name}. Removing it.")
+        servers.extend(named)
+    server_steps = {f"server {server.name} {server.id}": (functools.partial(delete_server, conn, snapshot, fip_pool, server), []) for server in servers}
+    steps = dict(server_steps)
+    steps.update({
+        'keypair': (functools.partial(delete_keypair, conn, keypair_name), []),
+        'files': (functools.partial(delete_files, tag_name, directory, snapshot), ['keypair', 'network', 'security group']),
+        'servers deleted': (functools.partial(wait_for_servers_deleted, conn, snapshot, tag_name, [server.id for server in servers]), list(server_steps)),
+        'vip port': (functools.partial(delete_ports, conn, snapshot, [vip_port]), ['servers deleted']),
+        'router': (functools.partial(delete_router, conn, snapshot, router_name), ['servers deleted', 'vip port']),
+        'subnet': (functools.partial(delete_subnets, conn, snapshot, [subnet_name]), ['router', 'vip port']),
+        'network': (functools.partial(delete_network, conn, snapshot, network_name), ['subnet']),
+        'security group': (functools.partial(delete_security_group, conn, snapshot, security_group_name), ['subnet']),
+    })
+    run_teardown(steps)
 
     print(f"Checking for {tag_name} in project.")
     print("(network)(subnet)(router)(security groups)(keypairs)")
     print("Cleanup done.")
 
-# Parse arguments
-parser = argparse.ArgumentParser()
-parser.add_argument('rc_file', help='OpenStack RC file')
-parser.add_argument('tag_name', help='Tag name for resources')
-args = parser.parse_args()
-
-# Load OpenStack RC file
-with open(args.rc_file) as f:
-    for line in f:
-        if line.strip() and not line.startswith('#'):
-            key, value = line.split('=', 1)
-            os.environ[key.strip()] = value.strip()
-
-# Create connection to OpenStack
-conn = connect_to_openstack()
-# Cleanup instances
-cleanup_instances(conn, args.tag_name)
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('rc_file', help='OpenStack RC file')
+    parser.add_argument('tag_name', help='Tag name for resources')
+    parser.add_argument('--release-floating-ips', action='store_true', help='Delete floating IPs instead of returning them to the pool')
+    args = parser.parse_args()
+
+    # Load OpenStack RC file
+    with open(args.rc_file) as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                key, value = line.split('=', 1)
+                os.environ[key.strip()] = value.strip()
+
+    # Create connection to OpenStack
+    conn = connect_to_openstack()
+    # Cleanup instances
+    cleanup_instances(conn, args.tag_name, args.release_floating_ips)
@@ -0,0 +1,61 @@
+import os
+import base64
+
+APP_DIR = '/home/flask-app'
+APP_PORT = 5000
+BOOTSTRAP_MARKER = f'{APP_DIR}/.bootstrapped'
+CLOUD_INIT_ENABLED = os.getenv('DEV_CLOUD_INIT', '1') != '0'
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+SERVICE_UNIT = f"""[Unit]
+Description=Flask app under gunicorn
+After=network-online.target
+
+[Service]
+WorkingDirectory={APP_DIR}
+ExecStart=/usr/local/bin/gunicorn --bind 0.0.0.0:{APP_PORT} app:app
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+def find_app_source():
+    # Same file the devservers play copies: configurations/service.py next to
+    # scripts/, falling back to the copy shipped alongside this module.
+    for path in ('configurations/service.py',
+                 os.path.join(basedir, '..', 'configurations', 'service.py'),
+                 os.path.join(basedir, 'service.py')):
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError("service.py not found")
+
+def encode(text):
+    return base64.b64encode(text.encode()).decode()
+
+def dev_server_cloud_config(app_path=None):
+    with open(app_path or find_app_source(), 'r') as f:
+        app_source = f.read()
+    return f"""#cloud-config
+package_update: true
+packages:
+  - python3-pip
+  - snmpd
+write_files:
+  - path: {APP_DIR}/app.py
+    encoding: b64
+    content: {encode(app_source)}
+  - path: /etc/systemd/system/flask-app.service
+    encoding: b64
+    content: {encode(SERVICE_UNIT)}
+runcmd:
+  # One shell, so the marker is only written once every step has succeeded.
+  - [sh, -c, 'set -e; pip3 install flask gunicorn; systemctl daemon-reload; systemctl enable --now flask-app.service; touch {BOOTSTRAP_MARKER}']
+"""
+
+def dev_server_user_data(app_path=None):
+    # Nova expects user_data base64 encoded.
+    if not CLOUD_INIT_ENABLED:
+        return None
+    return encode(dev_server_cloud_config(app_path))
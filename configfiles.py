@@ -1,16 +1,22 @@
-import openstack
+import token_cache
 import os
+import re
 import sys
+import hashlib
+import tempfile
 import subprocess
+from tracing import span, traced, trace_connection
 
 def run_command(command):
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    output, error = process.communicate()
+    with span(' '.join(command.split()[:2]), 'subprocess', command=command):
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        output, error = process.communicate()
     if process.returncode != 0:
         print(f"Error executing command: {command}\n{error.decode()}")
         sys.exit(1)
     return output.decode()
 
+@traced()
 def fetch_internal_ips(conn, tag_name):
     servers = conn.compute.servers(details=True, all_projects=False, filters={"name": f"{tag_name}*"})
     internal_ips = {}
@@ -43,98 +49,161 @@ def add_to_known_hosts(ip_address):
     return result
 """
 
-def generate_ssh_config(internal_ips, fip_map, tag_name, key_path):
+def natural_key(server_name):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', server_name)]
+
+def write_if_changed(path, content, mode=0o644):
+    # Compares the rendered content with what is on disk and only replaces the
+    # file when it differs. The new file is written next to the old one and
+    # renamed over it, so readers never see a half-written file.
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    try:
+        with open(path, 'rb') as f:
+            if hashlib.sha256(f.read()).hexdigest() == digest:
+                return False
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+def render_ssh_config(internal_ips, fip_map, tag_name, key_path):
     bastion_name = f"{tag_name}_bastion"
     haproxy_server = f"{tag_name}_HAproxy"
     haproxy_server2 = f"{tag_name}_HAproxy2"
     bastion_fip = fip_map.get(bastion_name, "")
     haproxy_fip1 = fip_map.get(haproxy_server, "")
     haproxy_fip2 = fip_map.get(haproxy_server2, "")
-    config_path = os.path.expanduser('~/.ssh/config')
-
-    with open(config_path, 'w') as f:
-        f.write("Host *\n")
-        f.write("\tUser ubuntu\n")
-        f.write(f"\tIdentityFile {key_path}\n")
-        f.write("\tStrictHostKeyChecking no\n")
-        f.write("\tPasswordAuthentication no\n")
-        f.write("\tServerAliveInterval 60\n")
-        f.write("\tForwardAgent yes\n")
-        f.write("\tControlMaster auto\n")
-        f.write("\tControlPath ~/.ssh/ansible-%r@%h:%p\n")
-        f.write("\tControlPersist yes\n\n")
-
-        if bastion_fip:
-            f.write(f"Host {bastion_name}\n")
-            f.write(f"\tHostName {bastion_fip}\n")
-        if haproxy_fip1:
-            f.write(f"Host {haproxy_server}\n")
-            f.write(f"\tHostName {haproxy_fip1}\n")
-            f.write(f"\tProxyJump {bastion_name}\n")
-        if haproxy_fip2:
-            f.write(f"Host {haproxy_server2}\n")
-            f.write(f"\tHostName {haproxy_fip2}\n")
-            f.write(f"\tProxyJump {bastion_name}\n")
-
-        for server_name, internal_ip in internal_ips.items():
-            if 'dev' in server_name:
-                f.write(f"Host {server_name}\n")
-                f.write(f"\tHostName {internal_ip}\n")
-                f.write(f"\tProxyJump {bastion_name}\n")
-
-def generate_ansible_config(tag_name, fip_map, bastion_name, key_path):
-
-    with open('ansible.cfg', 'w') as f:
-        f.write("[defaults]\n")
-        f.write("inventory = hosts\n")
-        f.write("remote_user = ubuntu\n")
-        f.write(f"private_key_file = {key_path}\n")
-        f.write("host_key_checking = False\n")
-        f.write("control_path = ~/.ssh/ansible-%r@%h:%p\n")
-        f.write("control_master = auto\n")
-        f.write("control_persist = yes\n")
-        f.write("ssh_args = -o ForwardAgent=yes\n")
-        f.write(f"ansible_ssh_common_args = -o ProxyJump=ubuntu@{fip_map.get(bastion_name, '')} -o IdentityFile={key_path}\n")
-
-def generate_host_file(internal_ips, fip_map, tag_name, key_path):
+
+    lines = [
+        "Host *\n",
+        "\tUser ubuntu\n",
+        f"\tIdentityFile {key_path}\n",
+        "\tStrictHostKeyChecking no\n",
+        "\tPasswordAuthentication no\n",
+        "\tServerAliveInterval 60\n",
+        "\tForwardAgent yes\n",
+        "\tControlMaster auto\n",
+        "\tControlPath ~/.ssh/ansible-%r@%h:%p\n",
+        "\tControlPersist yes\n\n",
+    ]
+    if bastion_fip:
+        lines.append(f"Host {bastion_name}\n")
+        lines.append(f"\tHostName {bastion_fip}\n")
+    if haproxy_fip1:
+        lines.append(f"Host {haproxy_server}\n")
+        lines.append(f"\tHostName {haproxy_fip1}\n")
+        lines.append(f"\tProxyJump {bastion_name}\n")
+    if haproxy_fip2:
+        lines.append(f"Host {haproxy_server2}\n")
+        lines.append(f"\tHostName {haproxy_fip2}\n")
+        lines.append(f"\tProxyJump {bastion_name}\n")
+
+    for server_name in sorted(internal_ips, key=natural_key):
+        if 'dev' in server_name:
+            lines.append(f"Host {server_name}\n")
+            lines.append(f"\tHostName {internal_ips[server_name]}\n")
+            lines.append(f"\tProxyJump {bastion_name}\n")
+    return ''.join(lines)
+
+@traced(kind='file')
+def generate_ssh_config(internal_ips, fip_map, tag_name, key_path, config_path=None):
+    config_path = config_path or os.path.expanduser('~/.ssh/config')
+    os.makedirs(os.path.dirname(config_path), mode=0o700, exist_ok=True)
+    return write_if_changed(config_path, render_ssh_config(internal_ips, fip_map, tag_name, key_path), 0o600)
+
+ANSIBLE_MIN_FORKS = 5
+ANSIBLE_MAX_FORKS = int(os.getenv('ANSIBLE_MAX_FORKS', '50'))
+FACT_CACHE_DIR = '.ansible_facts'
+FACT_CACHE_TIMEOUT = int(os.getenv('ANSIBLE_FACT_CACHE_TIMEOUT', '7200'))
+
+def render_ansible_config(tag_name, fip_map, bastion_name, key_path, host_count=0):
+    # One fork per host so a play touches every server in a single wave.
+    forks = max(ANSIBLE_MIN_FORKS, min(host_count, ANSIBLE_MAX_FORKS))
+    return (
+        "[defaults]\n"
+        "inventory = hosts\n"
+        "remote_user = ubuntu\n"
+        f"private_key_file = {key_path}\n"
+        "host_key_checking = False\n"
+        f"forks = {forks}\n"
+        "gathering = smart\n"
+        "fact_caching = jsonfile\n"
+        f"fact_caching_connection = {FACT_CACHE_DIR}\n"
+        f"fact_caching_timeout = {FACT_CACHE_TIMEOUT}\n"
+        "\n"
+        "[ssh_connection]\n"
+        "pipelining = True\n"
+        "control_path = ~/.ssh/ansible-%%r@%%h:%%p\n"
+        "ssh_args = -o ControlMaster=auto -o ControlPersist=300s -o ForwardAgent=yes\n"
+    )
+
+@traced(kind='file')
+def generate_ansible_config(tag_name, fip_map, bastion_name, key_path, host_count=0, path='ansible.cfg'):
+    return write_if_changed(path, render_ansible_config(tag_name, fip_map, bastion_name, key_path, host_count))
+
+def render_host_file(internal_ips, fip_map, tag_name, key_path):
     bastion_name = f"{tag_name}_bastion"
     haproxy_server = f"{tag_name}_HAproxy"
     haproxy_server2 = f"{tag_name}_HAproxy2"
 
-    with open('hosts', 'w') as f:
-        f.write("[bastion]\n")
-        if bastion_name in internal_ips:
-            f.write(f"{bastion_name} ansible_host={fip_map.get(bastion_name, '')} ansible_user=ubuntu ansible_ssh_private_key_file={key_path}\n\n")
-
-        f.write("[main_proxy]\n")
-        if haproxy_server in internal_ips:
-            f.write(f"{haproxy_server} ansible_host={fip_map.get(haproxy_server, '')} ansible_user=ubuntu ansible_ssh_private_key_file={key_path} ansible_ssh_common_args='-o ProxyJump=ubuntu@{fip_map.get(bastion_name, '')} -i {key_path}'\n")
-        
-        f.write("\n[standby_proxy]\n")
-        if haproxy_server2 in internal_ips:
-            f.write(f"{haproxy_server2} ansible_host={fip_map.get(haproxy_server2, '')} ansible_user=ubuntu ansible_ssh_private_key_file={key_path} ansible_ssh_common_args='-o ProxyJump=ubuntu@{fip_map.get(bastion_name, '')} -i {key_path}'\n")
-
-        f.write("\n[devservers]\n")
-        for server_name, internal_ip in internal_ips.items():
-            if 'dev' in server_name:
-                f.write(f"{server_name} ansible_host={internal_ip} ansible_user=ubuntu ansible_ssh_private_key_file={key_path} ansible_ssh_common_args='-o ProxyJump=ubuntu@{fip_map.get(bastion_name, '')} -i {key_path}'\n")
-
-def main(tag_name, key_path):
+    lines = ["[bastion]\n"]
+    if bastion_name in internal_ips:
+        lines.append(f"{bastion_name} ansible_host={fip_map.get(bastion_name, '')} ansible_user=ubuntu ansible_ssh_private_key_file={key_path}\n\n")
+
+    lines.append("[main_proxy]\n")
+    if haproxy_server in internal_ips:
+        lines.append(f"{haproxy_server} ansible_host={fip_map.get(haproxy_server, '')} ansible_user=ubuntu ansible_ssh_private_key_file={key_path} ansible_ssh_common_args='-o ProxyJump=ubuntu@{fip_map.get(bastion_name, '')} -i {key_path}'\n")
+
+    lines.append("\n[standby_proxy]\n")
+    if haproxy_server2 in internal_ips:
+        lines.append(f"{haproxy_server2} ansible_host={fip_map.get(haproxy_server2, '')} ansible_user=ubuntu ansible_ssh_private_key_file={key_path} ansible_ssh_common_args='-o ProxyJump=ubuntu@{fip_map.get(bastion_name, '')} -i {key_path}'\n")
+
+    lines.append("\n[devservers]\n")
+    for server_name in sorted(internal_ips, key=natural_key):
+        if 'dev' in server_name:
+            lines.append(f"{server_name} ansible_host={internal_ips[server_name]} ansible_user=ubuntu ansible_ssh_private_key_file={key_path} ansible_ssh_common_args='-o ProxyJump=ubuntu@{fip_map.get(bastion_name, '')} -i {key_path}'\n")
+    return ''.join(lines)
+
+@traced(kind='file')
+def generate_host_file(internal_ips, fip_map, tag_name, key_path, path='hosts'):
+    return write_if_changed(path, render_host_file(internal_ips, fip_map, tag_name, key_path))
+
+@traced('gen_config')
+def main(tag_name, key_path, conn=None, directory=''):
+    # Deploy.py and operate.py call this in-process with their connection.
+    # multideploy.py passes a per-tag directory, which also takes the place
+    # of the home directory for the SSH config.
     print(f"Received tag_name: {tag_name}, key_path: {key_path}")
     
     # Establish connection with OpenStack
-    conn = openstack.connect()
+    if conn is None:
+        with span('connect', 'api'):
+            conn = trace_connection(token_cache.connect())
 
     internal_ips = fetch_internal_ips(conn, tag_name)
-    fip_map = read_fip_file('servers_fip')
+    fip_map = read_fip_file(os.path.join(directory, 'servers_fip'))
     print("Internal IPs:", internal_ips)
     print("Floating IPs:", fip_map)
-    generate_ssh_config(internal_ips, fip_map, tag_name, key_path)
-    print("Generated SSH config.")
-    #generate_ansible_config(tag_name, fip_map, f"{tag_name}_bastion", key_path)
-    print("Generated Ansible config.")
-    generate_host_file(internal_ips, fip_map, tag_name, key_path)
-    print("Generated hosts file.")
+    ssh_changed = generate_ssh_config(internal_ips, fip_map, tag_name, key_path, os.path.join(directory, '.ssh', 'config') if directory else None)
+    print("Generated SSH config." if ssh_changed else "SSH config unchanged.")
+    ansible_changed = generate_ansible_config(tag_name, fip_map, f"{tag_name}_bastion", key_path, len(internal_ips), os.path.join(directory, 'ansible.cfg'))
+    print("Generated Ansible config." if ansible_changed else "Ansible config unchanged.")
+    hosts_changed = generate_host_file(internal_ips, fip_map, tag_name, key_path, os.path.join(directory, 'hosts'))
+    print("Generated hosts file." if hosts_changed else "Hosts file unchanged.")
+    changed = ssh_changed or ansible_changed or hosts_changed
+    print("Configuration updated." if changed else "Configuration unchanged.")
+    return changed
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
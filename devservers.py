@@ -0,0 +1,121 @@
+import os
+import time
+import datetime
+import concurrent.futures
+from haproxy_runtime import BackendManager, proxy_hosts, proxy_transport
+from tracing import traced
+
+# Dev server bookkeeping shared by the Deploy scripts and operate: which
+# indexes new servers get, and which servers go on scale-down and how.
+
+# Which dev servers go first on scale-down: highest_index or least_loaded
+SCALE_DOWN_POLICY = os.getenv('SCALE_DOWN_POLICY', 'highest_index')
+DRAIN_TIMEOUT = int(os.getenv('DRAIN_TIMEOUT', '30'))
+DELETE_TIMEOUT = 300
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{timestamp} {message}")
+
+def list_dev_servers(conn, tag_name):
+    return {server.name: server for server in conn.compute.servers(details=True, name=f"^{tag_name}_dev")}
+
+def server_index(server, prefix):
+    suffix = server.name[len(prefix):]
+    return int(suffix) if suffix.isdigit() else 0
+
+def free_indexes(dev_servers, prefix, count):
+    # The lowest indexes not taken by an existing dev server, so the gaps an
+    # earlier scale-down left are filled before the numbering grows.
+    used = {server_index(server, prefix) for server in dev_servers}
+    return [i for i in range(1, count + len(used) + 1) if i not in used][:count]
+
+def internal_ip(server):
+    for addresses in (server.addresses or {}).values():
+        for address in addresses:
+            if address.get('OS-EXT-IPS:type') == 'fixed':
+                return address['addr']
+    return None
+
+def backend_managers(hosts):
+    return [BackendManager(proxy_transport(hostvars)) for hostvars in proxy_hosts(hosts or {}).values()]
+
+def backend_sessions(managers, address):
+    # Sessions summed over the proxies, None if no proxy could tell.
+    counts = []
+    for manager in managers:
+        try:
+            counts.append(manager.sessions(address))
+        except Exception as e:
+            log(f"Could not read sessions for {address}: {e}")
+    counts = [count for count in counts if count is not None]
+    return sum(counts) if counts else None
+
+def pick_victims(dev_servers, count, prefix, managers, policy=SCALE_DOWN_POLICY):
+    by_index = sorted(dev_servers, key=lambda server: server_index(server, prefix), reverse=True)
+    if policy == 'least_loaded' and managers:
+        load = {server.id: backend_sessions(managers, internal_ip(server)) for server in by_index}
+        # Unknown load sorts last, ties keep the highest index first.
+        by_index.sort(key=lambda server: float('inf') if load[server.id] is None else load[server.id])
+    return by_index[:count]
+
+@traced(kind='wait')
+def drain_servers(managers, servers, timeout=DRAIN_TIMEOUT, delay=1):
+    # Stops new sessions to the victims on every proxy and waits for the
+    # open ones to finish, up to timeout.
+    addresses = [address for address in map(internal_ip, servers) if address]
+    for manager in managers:
+        for address in addresses:
+            try:
+                manager.drain(address)
+            except Exception as e:
+                log(f"Could not drain {address}: {e}")
+    deadline = time.monotonic() + timeout
+    while addresses and managers and time.monotonic() < deadline:
+        busy = [address for address in addresses if backend_sessions(managers, address)]
+        if not busy:
+            break
+        log(f"Waiting for sessions to finish on {', '.join(busy)}.")
+        time.sleep(delay)
+
+@traced(kind='wait')
+def wait_for_deleted(conn, tag_name, server_ids, timeout=DELETE_TIMEOUT, max_delay=10):
+    # One filtered list per round covers every deleted server.
+    remaining = set(server_ids)
+    deadline = time.monotonic() + timeout
+    delay = 1
+    while remaining and time.monotonic() < deadline:
+        time.sleep(delay)
+        remaining &= {server.id for server in list_dev_servers(conn, tag_name).values()}
+        delay = min(delay * 2, max_delay)
+    return remaining
+
+@traced()
+def remove_dev_servers(conn, tag_name, dev_servers, count, hosts=None, policy=SCALE_DOWN_POLICY):
+    # Picks count victims, drains them on the proxies in hosts, deletes them
+    # concurrently and waits until they are gone. Returns the servers whose
+    # delete was accepted.
+    prefix = f"{tag_name}_dev"
+    managers = backend_managers(hosts)
+    victims = pick_victims(dev_servers, count, prefix, managers, policy)
+    if not victims:
+        return []
+    log(f"Removing {', '.join(server.name for server in victims)} ({policy}).")
+    drain_servers(managers, victims)
+
+    def delete(server):
+        try:
+            conn.compute.delete_server(server.id)
+            return server.id
+        except Exception as e:
+            log(f"Failed to delete server {server.name}: {e}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(victims)) as executor:
+        deleted = [server_id for server_id in executor.map(delete, victims) if server_id]
+    remaining = wait_for_deleted(conn, tag_name, deleted)
+    for server in victims:
+        if server.id in deleted and server.id not in remaining:
+            log(f"Server {server.name} deleted successfully.")
+        elif server.id in remaining:
+            log(f"Server {server.name} still present after {DELETE_TIMEOUT}s.")
+    return [server for server in victims if server.id in deleted]
@@ -0,0 +1,450 @@
+import re
+import time
+import uuid
+import random
+import ipaddress
+import threading
+import collections
+import openstack.exceptions
+
+# In-memory stand-in for openstack.connect(). It implements the compute and
+# network calls the deploy, operate, cleanup and gen_config scripts make, with
+# per-call latency, boot and delete delays and failure injection, so the
+# orchestration can be timed at fleet sizes no test project would allow.
+#
+#   cloud = FakeCloud(latency=0.05, boot_delay=2)
+#   openstack.connect = cloud.connect
+
+IMAGES = ('Ubuntu 20.04 Focal Fossa x86_64',)
+FLAVORS = ('1C-2GB-50GB',)
+EXTERNAL_NETWORK = 'ext-net'
+FLOATING_RANGE = '172.16.0.0/16'
+
+class Resource:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+    def __getattr__(self, attribute):
+        # Unset SDK attributes read as None, like on the real resources
+        if attribute.startswith('__'):
+            raise AttributeError(attribute)
+        return None
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return self.__dict__.get(key, default)
+
+    def copy(self, **changes):
+        attributes = dict(self.__dict__)
+        attributes.update(changes)
+        return Resource(**attributes)
+
+    def __repr__(self):
+        return f"Resource(name={self.name!r}, id={self.id!r})"
+
+def resource_id(resource):
+    return resource if isinstance(resource, str) else resource.id
+
+class FakeCloud:
+    def __init__(self, latency=0.0, jitter=0.0, boot_delay=0.0, delete_delay=0.0, failure_rate=0.0, fail_calls=None,
+                 strict_ip_pools=True, seed=None, project_id='fake-project'):
+        self.latency = latency
+        self.jitter = jitter
+        self.boot_delay = boot_delay
+        self.delete_delay = delete_delay
+        # Random failures on every mutating call, plus "method name -> count"
+        # for failures that must happen on the next calls of one method.
+        self.failure_rate = failure_rate
+        self.fail_calls = collections.Counter(fail_calls or {})
+        # Ports get addresses from the subnet's allocation pool only, as in
+        # Neutron. False hands out the whole CIDR.
+        self.strict_ip_pools = strict_ip_pools
+        self.random = random.Random(seed)
+        self.project_id = project_id
+        self.lock = threading.RLock()
+        self.calls = collections.Counter()
+        self.resources = {kind: {} for kind in ('server', 'port', 'ip', 'network', 'subnet', 'router', 'security_group', 'keypair')}
+        self.next_address = {}
+        self.floating_addresses = ipaddress.ip_network(FLOATING_RANGE).hosts()
+        self.images = {name: Resource(id=str(uuid.uuid4()), name=name) for name in IMAGES}
+        self.flavors = {name: Resource(id=str(uuid.uuid4()), name=name) for name in FLAVORS}
+        self.add('network', name=EXTERNAL_NETWORK, is_router_external=True, project_id='admin')
+
+    def connect(self, *args, **kwargs):
+        return FakeConnection(self)
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def call(self, name, mutating):
+        # Latency is spent outside the lock so concurrent callers overlap, like
+        # real API requests do.
+        with self.lock:
+            self.calls[name] += 1
+            forced = self.fail_calls[name] > 0
+            if forced:
+                self.fail_calls[name] -= 1
+            fail = forced or (mutating and self.failure_rate and self.random.random() < self.failure_rate)
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise openstack.exceptions.HttpException(message=f"Injected failure in {name}")
+
+    def add(self, kind, **attributes):
+        with self.lock:
+            attributes.setdefault('project_id', self.project_id)
+            resource = Resource(id=str(uuid.uuid4()), created=time.monotonic(), **attributes)
+            self.resources[kind][resource.id] = resource
+            return resource
+
+    def lookup(self, kind, resource, ignore_missing=True):
+        with self.lock:
+            found = self.resources[kind].get(resource_id(resource))
+        if found is None and not ignore_missing:
+            raise openstack.exceptions.ResourceNotFound(message=f"No {kind} found for {resource_id(resource)}")
+        return found
+
+    def find(self, kind, name_or_id):
+        with self.lock:
+            if name_or_id in self.resources[kind]:
+                return self.resources[kind][name_or_id]
+            matches = [resource for resource in self.resources[kind].values() if resource.name == name_or_id]
+        if len(matches) > 1:
+            raise openstack.exceptions.DuplicateResource(message=f"More than one {kind} named {name_or_id}")
+        return matches[0] if matches else None
+
+    def select(self, kind, **filters):
+        with self.lock:
+            resources = list(self.resources[kind].values())
+        return [resource for resource in resources if all(getattr(resource, key) == value for key, value in filters.items() if value is not None)]
+
+    def allocate_address(self, subnet):
+        network = ipaddress.ip_network(subnet.cidr)
+        with self.lock:
+            if self.strict_ip_pools and subnet.allocation_pools:
+                pool = subnet.allocation_pools[0]
+                first, last = ipaddress.ip_address(pool['start']), ipaddress.ip_address(pool['end'])
+            else:
+                first, last = network.network_address + 2, network.broadcast_address - 1
+            used = {fixed_ip['ip_address'] for port in self.resources['port'].values() for fixed_ip in port.fixed_ips if fixed_ip['subnet_id'] == subnet.id}
+            address = self.next_address.get(subnet.id, first)
+            for _ in range(int(last) - int(first) + 1):
+                if address > last:
+                    address = first
+                if str(address) not in used:
+                    self.next_address[subnet.id] = address + 1
+                    return str(address)
+                address += 1
+        raise openstack.exceptions.ConflictException(message=f"No more IP addresses available on subnet {subnet.id}")
+
+    def create_port(self, network_id, name=None, security_groups=None, device_id='', device_owner=''):
+        subnets = self.select('subnet', network_id=network_id)
+        fixed_ips = [{'subnet_id': subnets[0].id, 'ip_address': self.allocate_address(subnets[0])}] if subnets else []
+        return self.add('port', name=name or '', network_id=network_id, fixed_ips=fixed_ips, security_group_ids=list(security_groups or []),
+                        device_id=device_id, device_owner=device_owner)
+
+    def server_view(self, server):
+        # What a GET returns right now: status and addresses follow the boot
+        # and delete timers and the floating IPs bound to the server's ports.
+        now = time.monotonic()
+        with self.lock:
+            if server.deleted is not None and now >= server.deleted:
+                self.resources['server'].pop(server.id, None)
+                return None
+            status = 'DELETING' if server.deleted is not None else ('ACTIVE' if now >= server.created + self.boot_delay else 'BUILD')
+            addresses = {}
+            if status != 'BUILD':
+                for port in self.resources['port'].values():
+                    if port.device_id != server.id:
+                        continue
+                    network = self.resources['network'].get(port.network_id)
+                    entries = addresses.setdefault(network.name if network else port.network_id, [])
+                    for fixed_ip in port.fixed_ips:
+                        entries.append({'addr': fixed_ip['ip_address'], 'version': 4, 'OS-EXT-IPS:type': 'fixed'})
+                    for floating_ip in self.resources['ip'].values():
+                        if floating_ip.port_id == port.id:
+                            entries.append({'addr': floating_ip.floating_ip_address, 'version': 4, 'OS-EXT-IPS:type': 'floating'})
+            return server.copy(status=status, addresses=addresses)
+
+    def delete_server(self, server):
+        with self.lock:
+            server.deleted = time.monotonic() + self.delete_delay
+            for port in list(self.resources['port'].values()):
+                if port.device_id != server.id:
+                    continue
+                if port.device_owner == 'compute:auto':
+                    # Ports nova created go with the server, together with
+                    # the bindings of their floating IPs.
+                    for floating_ip in self.resources['ip'].values():
+                        if floating_ip.port_id == port.id:
+                            floating_ip.port_id = None
+                            floating_ip.fixed_ip_address = None
+                    del self.resources['port'][port.id]
+                else:
+                    port.device_id = ''
+                    port.device_owner = ''
+        if not self.delete_delay:
+            self.server_view(server)
+
+class ComputeProxy:
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def find_image(self, name_or_id, ignore_missing=True):
+        self.cloud.call('compute.find_image', False)
+        return self.cloud.images.get(name_or_id) or next((image for image in self.cloud.images.values() if image.id == name_or_id), None)
+
+    def find_flavor(self, name_or_id, ignore_missing=True):
+        self.cloud.call('compute.find_flavor', False)
+        return self.cloud.flavors.get(name_or_id) or next((flavor for flavor in self.cloud.flavors.values() if flavor.id == name_or_id), None)
+
+    def find_keypair(self, name_or_id, ignore_missing=True):
+        self.cloud.call('compute.find_keypair', False)
+        return self.cloud.find('keypair', name_or_id)
+
+    def create_keypair(self, name, public_key=None, **attributes):
+        self.cloud.call('compute.create_keypair', True)
+        if self.cloud.find('keypair', name):
+            raise openstack.exceptions.ConflictException(message=f"Key pair {name} already exists")
+        return self.cloud.add('keypair', name=name, public_key=public_key)
+
+    def delete_keypair(self, keypair, ignore_missing=True):
+        self.cloud.call('compute.delete_keypair', True)
+        found = self.cloud.find('keypair', resource_id(keypair))
+        if found is None:
+            if not ignore_missing:
+                raise openstack.exceptions.ResourceNotFound(message=f"Key pair {resource_id(keypair)} not found")
+            return
+        with self.cloud.lock:
+            self.cloud.resources['keypair'].pop(found.id, None)
+
+    def create_server(self, name, image_id=None, flavor_id=None, networks=None, key_name=None, security_groups=None, user_data=None, **attributes):
+        self.cloud.call('compute.create_server', True)
+        server = self.cloud.add('server', name=name, image_id=image_id, flavor_id=flavor_id, key_name=key_name, user_data=user_data,
+                                security_groups=[{'name': group['name']} for group in security_groups or []] or [{'name': 'default'}],
+                                deleted=None)
+        for network in networks or []:
+            if 'port' in network:
+                port = self.cloud.lookup('port', network['port'], ignore_missing=False)
+                with self.cloud.lock:
+                    port.device_id = server.id
+                    port.device_owner = 'compute:nova'
+                if port.security_group_ids:
+                    groups = [self.cloud.lookup('security_group', group_id) for group_id in port.security_group_ids]
+                    server.security_groups = [{'name': group.name} for group in groups if group]
+            else:
+                self.cloud.create_port(network['uuid'], device_id=server.id, device_owner='compute:auto')
+        return server.copy(status='BUILD', addresses={})
+
+    def get_server(self, server):
+        self.cloud.call('compute.get_server', False)
+        found = self.cloud.lookup('server', server, ignore_missing=False)
+        view = self.cloud.server_view(found)
+        if view is None:
+            raise openstack.exceptions.ResourceNotFound(message=f"Server {resource_id(server)} not found")
+        return view
+
+    def wait_for_server(self, server, status='ACTIVE', failures=None, interval=2, wait=120, **attributes):
+        # Polls like the SDK does, each poll is one GET.
+        deadline = time.monotonic() + wait
+        while True:
+            current = self.get_server(server)
+            if current.status == status:
+                return current
+            if time.monotonic() >= deadline:
+                raise openstack.exceptions.ResourceTimeout(f"Timeout waiting for {current.id} to reach {status}")
+            with self.cloud.lock:
+                found = self.cloud.resources['server'].get(current.id)
+            remaining = found.created + self.cloud.boot_delay - time.monotonic() if found else 0
+            time.sleep(max(0.0, min(interval, remaining)))
+
+    def servers(self, details=True, name=None, **query):
+        self.cloud.call('compute.servers', False)
+        with self.cloud.lock:
+            servers = list(self.cloud.resources['server'].values())
+        pattern = re.compile(name) if name else None
+        views = (self.cloud.server_view(server) for server in servers if not pattern or pattern.search(server.name))
+        return iter([view for view in views if view is not None])
+
+    def delete_server(self, server, ignore_missing=True, force=False):
+        self.cloud.call('compute.delete_server', True)
+        found = self.cloud.lookup('server', server, ignore_missing)
+        if found is not None:
+            self.cloud.delete_server(found)
+
+    def server_interfaces(self, server):
+        self.cloud.call('compute.server_interfaces', False)
+        server_id = resource_id(server)
+        return iter([Resource(id=port.id, port_id=port.id, net_id=port.network_id, server_id=server_id)
+                     for port in self.cloud.select('port', device_id=server_id)])
+
+    def create_server_interface(self, server, port_id=None, net_id=None, **attributes):
+        self.cloud.call('compute.create_server_interface', True)
+        server_id = resource_id(server)
+        if port_id:
+            port = self.cloud.lookup('port', port_id, ignore_missing=False)
+            with self.cloud.lock:
+                port.device_id = server_id
+                port.device_owner = 'compute:nova'
+        else:
+            port = self.cloud.create_port(net_id, device_id=server_id, device_owner='compute:auto')
+        return Resource(id=port.id, port_id=port.id, net_id=port.network_id, server_id=server_id)
+
+class NetworkProxy:
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def listing(self, kind, **filters):
+        self.cloud.call(f'network.{kind}s', False)
+        return iter(self.cloud.select(kind, **filters))
+
+    def finding(self, kind, name_or_id):
+        self.cloud.call(f'network.find_{kind}', False)
+        return self.cloud.find(kind, name_or_id)
+
+    def deleting(self, kind, resource, ignore_missing=True, in_use=None):
+        self.cloud.call(f'network.delete_{kind}', True)
+        found = self.cloud.lookup(kind, resource, ignore_missing)
+        if found is None:
+            return
+        with self.cloud.lock:
+            if in_use and in_use(found):
+                raise openstack.exceptions.ConflictException(message=f"{kind} {found.id} is still in use")
+            del self.cloud.resources[kind][found.id]
+
+    def networks(self, name=None, **query):
+        return self.listing('network', name=name)
+
+    def subnets(self, name=None, network_id=None, **query):
+        return self.listing('subnet', name=name, network_id=network_id)
+
+    def routers(self, name=None, **query):
+        return self.listing('router', name=name)
+
+    def security_groups(self, name=None, project_id=None, **query):
+        return self.listing('security_group', name=name, project_id=project_id)
+
+    def ports(self, network_id=None, device_id=None, name=None, **query):
+        return self.listing('port', network_id=network_id, device_id=device_id, name=name)
+
+    def ips(self, project_id=None, floating_network_id=None, port_id=None, **query):
+        self.cloud.call('network.ips', False)
+        return iter(self.cloud.select('ip', project_id=project_id, floating_network_id=floating_network_id, port_id=port_id))
+
+    def find_network(self, name_or_id, ignore_missing=True):
+        return self.finding('network', name_or_id)
+
+    def find_subnet(self, name_or_id, ignore_missing=True):
+        return self.finding('subnet', name_or_id)
+
+    def find_router(self, name_or_id, ignore_missing=True):
+        return self.finding('router', name_or_id)
+
+    def find_security_group(self, name_or_id, ignore_missing=True):
+        return self.finding('security_group', name_or_id)
+
+    def create_network(self, name=None, **attributes):
+        self.cloud.call('network.create_network', True)
+        return self.cloud.add('network', name=name, **attributes)
+
+    def create_subnet(self, name=None, network_id=None, cidr=None, ip_version=4, allocation_pools=None, **attributes):
+        self.cloud.call('network.create_subnet', True)
+        self.cloud.lookup('network', network_id, ignore_missing=False)
+        return self.cloud.add('subnet', name=name, network_id=network_id, cidr=cidr, ip_version=ip_version, allocation_pools=allocation_pools or [])
+
+    def create_router(self, name=None, external_gateway_info=None, **attributes):
+        self.cloud.call('network.create_router', True)
+        return self.cloud.add('router', name=name, external_gateway_info=external_gateway_info)
+
+    def add_interface_to_router(self, router, subnet_id=None, port_id=None):
+        self.cloud.call('network.add_interface_to_router', True)
+        subnet = self.cloud.lookup('subnet', subnet_id, ignore_missing=False)
+        network = ipaddress.ip_network(subnet.cidr)
+        port = self.cloud.add('port', name='', network_id=subnet.network_id, device_id=resource_id(router), device_owner='network:router_interface',
+                              fixed_ips=[{'subnet_id': subnet.id, 'ip_address': str(network.network_address + 1)}], security_group_ids=[])
+        return {'id': resource_id(router), 'subnet_id': subnet.id, 'port_id': port.id}
+
+    def remove_interface_from_router(self, router, subnet_id=None, port_id=None):
+        self.cloud.call('network.remove_interface_from_router', True)
+        with self.cloud.lock:
+            for port in list(self.cloud.resources['port'].values()):
+                if port.device_id == resource_id(router) and (port.id == port_id or any(fixed_ip['subnet_id'] == subnet_id for fixed_ip in port.fixed_ips)):
+                    del self.cloud.resources['port'][port.id]
+                    return
+        raise openstack.exceptions.ResourceNotFound(message=f"Router {resource_id(router)} has no such interface")
+
+    def create_security_group(self, name=None, **attributes):
+        self.cloud.call('network.create_security_group', True)
+        return self.cloud.add('security_group', name=name, rules=[])
+
+    def create_security_group_rule(self, security_group_id=None, **rule):
+        self.cloud.call('network.create_security_group_rule', True)
+        group = self.cloud.lookup('security_group', security_group_id, ignore_missing=False)
+        with self.cloud.lock:
+            group.rules.append(rule)
+        return Resource(id=str(uuid.uuid4()), security_group_id=security_group_id, **rule)
+
+    def create_port(self, network_id=None, name=None, security_groups=None, **attributes):
+        self.cloud.call('network.create_port', True)
+        self.cloud.lookup('network', network_id, ignore_missing=False)
+        return self.cloud.create_port(network_id, name=name, security_groups=security_groups)
+
+    def create_ip(self, floating_network_id=None, port_id=None, **attributes):
+        self.cloud.call('network.create_ip', True)
+        with self.cloud.lock:
+            address = str(next(self.cloud.floating_addresses))
+        return self.cloud.add('ip', floating_ip_address=address, floating_network_id=floating_network_id, port_id=port_id, fixed_ip_address=None)
+
+    def update_ip(self, floating_ip, port_id=None, **attributes):
+        self.cloud.call('network.update_ip', True)
+        found = self.cloud.lookup('ip', floating_ip, ignore_missing=False)
+        with self.cloud.lock:
+            if port_id:
+                port = self.cloud.resources['port'].get(port_id)
+                if port is None:
+                    raise openstack.exceptions.ResourceNotFound(message=f"Port {port_id} not found")
+                found.fixed_ip_address = port.fixed_ips[0]['ip_address'] if port.fixed_ips else None
+            else:
+                found.fixed_ip_address = None
+            found.port_id = port_id
+            return found.copy()
+
+    def delete_port(self, port, ignore_missing=True):
+        return self.deleting('port', port, ignore_missing, lambda found: found.device_owner == 'network:router_interface')
+
+    def delete_ip(self, floating_ip, ignore_missing=True):
+        return self.deleting('ip', floating_ip, ignore_missing)
+
+    def delete_router(self, router, ignore_missing=True):
+        return self.deleting('router', router, ignore_missing,
+                             lambda found: bool(self.cloud.select('port', device_id=found.id)))
+
+    def delete_subnet(self, subnet, ignore_missing=True):
+        return self.deleting('subnet', subnet, ignore_missing,
+                             lambda found: any(fixed_ip['subnet_id'] == found.id for port in self.cloud.resources['port'].values() for fixed_ip in port.fixed_ips))
+
+    def delete_network(self, network, ignore_missing=True):
+        return self.deleting('network', network, ignore_missing,
+                             lambda found: bool(self.cloud.select('subnet', network_id=found.id) or self.cloud.select('port', network_id=found.id)))
+
+    def delete_security_group(self, security_group, ignore_missing=True):
+        return self.deleting('security_group', security_group, ignore_missing,
+                             lambda found: any(found.id in port.security_group_ids for port in self.cloud.resources['port'].values()))
+
+class FakeConnection:
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self.compute = ComputeProxy(cloud)
+        self.network = NetworkProxy(cloud)
+        self.current_project_id = cloud.project_id
+
+    def close(self):
+        pass
+
+def connect(*args, **kwargs):
+    # A fresh cloud per call; share one by using FakeCloud().connect instead.
+    return FakeCloud().connect()
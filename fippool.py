@@ -0,0 +1,77 @@
+import os
+import datetime
+import threading
+import collections
+import concurrent.futures
+
+FIP_WARM_RESERVE = int(os.getenv('FIP_WARM_RESERVE', '0'))
+
+class FloatingIPPool:
+    # Hands out the project's unattached floating IPs on the external network.
+    # The free list is built from one listing, topped up in concurrent batches
+    # and guarded by a lock, so parallel server creates never pick the same
+    # address. Released addresses go back on the free list instead of being
+    # deleted.
+
+    def __init__(self, conn, snapshot=None, network_name='ext-net', reserve=FIP_WARM_RESERVE):
+        self.conn = conn
+        self.snapshot = snapshot
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        self.network = snapshot.get('network', network_name) if snapshot else conn.network.find_network(network_name)
+        if not self.network:
+            raise Exception(f"Network {network_name} not found")
+        self.refresh()
+
+    def refresh(self):
+        if self.snapshot:
+            floating_ips = self.snapshot.all('ip')
+        else:
+            floating_ips = self.conn.network.ips(floating_network_id=self.network.id)
+        with self.lock:
+            self.free = collections.deque(floating_ip for floating_ip in floating_ips
+                                          if floating_ip.floating_network_id == self.network.id and not floating_ip.port_id)
+
+    def allocate(self, count):
+        if count <= 0:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=count) as executor:
+            created = list(executor.map(lambda _: self.conn.network.create_ip(floating_network_id=self.network.id), range(count)))
+        for floating_ip in created:
+            if self.snapshot:
+                self.snapshot.add('ip', floating_ip)
+            self.free.append(floating_ip)
+        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Allocated {count} floating IPs: {[floating_ip.floating_ip_address for floating_ip in created]}")
+
+    def fill(self, needed=0):
+        with self.lock:
+            self.allocate(needed + self.reserve - len(self.free))
+
+    def acquire(self):
+        with self.lock:
+            if not self.free:
+                self.allocate(max(self.reserve, 1))
+            return self.free.popleft()
+
+    def associate(self, port_id, snapshot=None):
+        # A pool shared between tags has no snapshot of its own, the caller
+        # passes the one of the tag it works for.
+        snapshot = snapshot or self.snapshot
+        floating_ip = self.acquire()
+        try:
+            floating_ip = self.conn.network.update_ip(floating_ip, port_id=port_id)
+        except Exception:
+            with self.lock:
+                self.free.appendleft(floating_ip)
+            raise
+        if snapshot:
+            snapshot.update('ip', floating_ip)
+        return floating_ip
+
+    def release(self, floating_ip):
+        floating_ip = self.conn.network.update_ip(floating_ip, port_id=None)
+        if self.snapshot:
+            self.snapshot.update('ip', floating_ip)
+        with self.lock:
+            self.free.append(floating_ip)
+        return floating_ip
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+import os
+import sys
+import shlex
+import socket
+import argparse
+import datetime
+import subprocess
+import concurrent.futures
+from tracing import span, traced
+
+# The proxies' haproxy.cfg is expected to carry a fixed pool of slots in the
+# dev server backend, all parked until this module gives them an address:
+#
+#   stats socket /run/haproxy/admin.sock mode 660 level admin
+#   backend webservers
+#       server-template dev 1-16 0.0.0.0:5000 check disabled init-addr none
+#
+# Adding or removing a dev server is then a runtime API call on the live
+# process. Only when every slot is taken does the caller fall back to
+# re-rendering the config, which ends in a graceful reload.
+
+HAPROXY_SOCKET = os.getenv('HAPROXY_SOCKET', '/run/haproxy/admin.sock')
+HAPROXY_BACKEND = os.getenv('HAPROXY_BACKEND', 'webservers')
+SLOT_PREFIX = os.getenv('HAPROXY_SLOT_PREFIX', 'dev')
+BACKEND_PORT = 5000
+SOCKET_TIMEOUT = 10
+# srv_admin_state bits: forced, inherited, config, resolver and hostname maintenance
+MAINT_FLAGS = 0x01 | 0x02 | 0x04 | 0x20 | 0x40
+UNSET_ADDRESSES = ('0.0.0.0', '::', '-')
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{timestamp} {message}")
+
+class UnixSocketTransport:
+    def __init__(self, path=HAPROXY_SOCKET):
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(SOCKET_TIMEOUT)
+        sock.connect(self.path)
+        return sock
+
+    def send(self, commands):
+        # Non-interactive mode: one line of ';'-separated commands, the
+        # proxy answers all of them and closes the connection.
+        with self.connect() as sock:
+            sock.sendall(('; '.join(commands) + '\n').encode())
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return b''.join(chunks).decode()
+
+class TcpTransport(UnixSocketTransport):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def connect(self):
+        return socket.create_connection((self.host, self.port), timeout=SOCKET_TIMEOUT)
+
+class SshTransport:
+    # Reaches the stats socket of a remote proxy through socat over SSH.
+    def __init__(self, address, user='ubuntu', ssh_args='', key_path=None, path=HAPROXY_SOCKET):
+        self.command = ['ssh', '-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=no', '-o', 'LogLevel=ERROR']
+        if key_path:
+            self.command += ['-i', key_path]
+        self.command += shlex.split(ssh_args) + [f'{user}@{address}', f'sudo socat stdio UNIX-CONNECT:{path}']
+
+    def send(self, commands):
+        process = subprocess.run(self.command, input=('; '.join(commands) + '\n').encode(),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=SOCKET_TIMEOUT * 3)
+        if process.returncode != 0:
+            raise Exception(f"runtime API over SSH failed: {process.stderr.decode().strip()}")
+        return process.stdout.decode()
+
+class BackendManager:
+    def __init__(self, transport, backend=HAPROXY_BACKEND, slot_prefix=SLOT_PREFIX, port=BACKEND_PORT):
+        self.transport = transport
+        self.backend = backend
+        self.slot_prefix = slot_prefix
+        self.port = port
+
+    def slots(self):
+        # slot name -> {'address', 'admin_state', 'operational_state'}
+        output = self.transport.send([f'show servers state {self.backend}'])
+        columns = None
+        slots = {}
+        for line in output.splitlines():
+            if line.startswith('# '):
+                columns = line[2:].split()
+                continue
+            fields = line.split()
+            if columns is None or len(fields) < len(columns):
+                continue
+            row = dict(zip(columns, fields))
+            if row['srv_name'].startswith(self.slot_prefix):
+                slots[row['srv_name']] = {
+                    'address': row['srv_addr'],
+                    'admin_state': int(row['srv_admin_state']),
+                    'operational_state': int(row['srv_op_state']),
+                }
+        if columns is None:
+            raise Exception(f"unexpected answer to show servers state: {output.strip()}")
+        return slots
+
+    def in_use(self, slots):
+        # address -> slot name, for the slots that carry a dev server
+        return {slot['address']: name for name, slot in slots.items()
+                if not slot['admin_state'] & MAINT_FLAGS and slot['address'] not in UNSET_ADDRESSES}
+
+    def set_state(self, address, state):
+        slots = self.slots()
+        name = self.in_use(slots).get(address)
+        if name is None:
+            return False
+        self.transport.send([f'set server {self.backend}/{name} state {state}'])
+        return True
+
+    def drain(self, address):
+        return self.set_state(address, 'drain')
+
+    def sessions(self, address):
+        # Current sessions on the slot serving address, None if it has no slot.
+        slots = self.slots()
+        name = self.in_use(slots).get(address)
+        if name is None:
+            return None
+        for line in self.transport.send([f'show stat {self.backend} 4 -1']).splitlines():
+            fields = line.split(',')
+            if len(fields) > 4 and fields[0] == self.backend and fields[1] == name:
+                return int(fields[4] or 0)
+        return None
+
+    def sync(self, addresses):
+        # Puts exactly these backend addresses into service. Returns False when
+        # there are not enough free slots, the removals are applied regardless.
+        slots = self.slots()
+        in_use = self.in_use(slots)
+        wanted = set(addresses)
+        commands = [f'set server {self.backend}/{name} state maint' for address, name in sorted(in_use.items()) if address not in wanted]
+        free = sorted((name for name in slots if name not in in_use.values()), key=lambda name: int(name[len(self.slot_prefix):] or 0))
+        free += sorted(name for address, name in in_use.items() if address not in wanted)
+        missing = sorted(wanted - set(in_use))
+        enough = len(missing) <= len(free)
+        for address, name in zip(missing, free):
+            commands += [
+                f'set server {self.backend}/{name} addr {address} port {self.port}',
+                f'set server {self.backend}/{name} state ready',
+            ]
+        if commands:
+            self.transport.send(commands)
+        in_service = set(self.in_use(self.slots()))
+        if not enough:
+            log(f"{self.backend}: {len(missing)} servers to add but only {len(free)} free slots.")
+        return enough and in_service == wanted
+
+def proxy_transport(hostvars):
+    return SshTransport(hostvars.get('ansible_host'), hostvars.get('ansible_user', 'ubuntu'),
+                        hostvars.get('ansible_ssh_common_args', ''), hostvars.get('ansible_ssh_private_key_file'))
+
+def proxy_hosts(hosts):
+    return {name: hostvars for name, hostvars in hosts.items() if 'HAproxy' in name}
+
+def dev_addresses(hosts):
+    return sorted(hostvars['ansible_host'] for name, hostvars in hosts.items() if 'dev' in name and hostvars.get('ansible_host'))
+
+@traced()
+def sync_backends(hosts, addresses=None):
+    # hosts is the inventory (name -> hostvars). Updates every proxy at once and
+    # returns True only if all of them now serve exactly the dev servers.
+    proxies = proxy_hosts(hosts)
+    if not proxies:
+        return False
+    addresses = dev_addresses(hosts) if addresses is None else addresses
+
+    def sync_proxy(name):
+        with span('haproxy runtime sync', 'api', proxy=name):
+            try:
+                return name, BackendManager(proxy_transport(proxies[name])).sync(addresses)
+            except Exception as e:
+                log(f"Runtime API on {name} failed: {e}")
+                return name, False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(proxies)) as executor:
+        results = dict(executor.map(sync_proxy, proxies))
+    for name, synced in sorted(results.items()):
+        log(f"{name}: backends {'updated in place' if synced else 'need a config reload'}.")
+    return all(results.values())
+
+if __name__ == "__main__":
+    from readiness import load_hosts, INVENTORY
+    parser = argparse.ArgumentParser(description='Point the HAProxy server-template slots at the current dev servers')
+    parser.add_argument('-i', '--inventory', default=INVENTORY)
+    parser.add_argument('--socket', help='Talk to a local stats socket (path or host:port) instead of the inventory proxies')
+    parser.add_argument('--show', action='store_true', help='Only print the slots')
+    args = parser.parse_args()
+
+    if args.socket:
+        host, _, port = args.socket.rpartition(':')
+        transport = TcpTransport(host, int(port)) if host and port.isdigit() else UnixSocketTransport(args.socket)
+        manager = BackendManager(transport)
+        if args.show:
+            for name, slot in sorted(manager.slots().items()):
+                print(name, slot['address'], slot['admin_state'], slot['operational_state'])
+            sys.exit(0)
+        sys.exit(0 if manager.sync(dev_addresses(load_hosts(args.inventory))) else 1)
+    sys.exit(0 if sync_backends(load_hosts(args.inventory)) else 1)
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import argparse
+import token_cache
+try:
+    import gen_config as configfiles
+except ImportError:
+    import configfiles
+
+CACHE_FILE = os.getenv('INVENTORY_CACHE', '.inventory_cache.json')
+CACHE_TTL = int(os.getenv('INVENTORY_TTL', '300'))
+FIP_FILE = 'servers_fip'
+
+def build_inventory(conn, tag_name, key_path, fip_file=FIP_FILE):
+    internal_ips = configfiles.fetch_internal_ips(conn, tag_name)
+    fip_map = configfiles.read_fip_file(fip_file) if os.path.exists(fip_file) else {}
+    bastion_name = f"{tag_name}_bastion"
+    proxy_jump = f"-o ProxyJump=ubuntu@{fip_map.get(bastion_name, '')} -i {key_path}"
+    groups = {
+        'bastion': [bastion_name],
+        'main_proxy': [f"{tag_name}_HAproxy"],
+        'standby_proxy': [f"{tag_name}_HAproxy2"],
+        'devservers': sorted((server_name for server_name in internal_ips if 'dev' in server_name), key=configfiles.natural_key),
+    }
+    inventory = {'_meta': {'hostvars': {}}}
+    for group, hosts in groups.items():
+        hosts = [host for host in hosts if host in internal_ips]
+        inventory[group] = {'hosts': hosts}
+        for host in hosts:
+            hostvars = {
+                'ansible_host': internal_ips[host] if group == 'devservers' else fip_map.get(host, ''),
+                'ansible_user': 'ubuntu',
+                'ansible_ssh_private_key_file': key_path,
+            }
+            if group != 'bastion':
+                hostvars['ansible_ssh_common_args'] = proxy_jump
+            inventory['_meta']['hostvars'][host] = hostvars
+    return inventory
+
+def read_cache(tag_name, key_path, cache_file=CACHE_FILE, ttl=CACHE_TTL):
+    try:
+        if time.time() - os.stat(cache_file).st_mtime > ttl:
+            return None
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return cached['inventory'] if (cached.get('tag_name'), cached.get('key_path')) == (tag_name, key_path) else None
+
+def write_cache(tag_name, key_path, inventory, cache_file=CACHE_FILE):
+    content = json.dumps({'tag_name': tag_name, 'key_path': key_path, 'inventory': inventory}, indent=2, sort_keys=True)
+    if not configfiles.write_if_changed(cache_file, content):
+        # Unchanged content still counts as a fresh lookup for the TTL.
+        os.utime(cache_file)
+
+def invalidate_cache(cache_file=CACHE_FILE):
+    try:
+        os.remove(cache_file)
+    except FileNotFoundError:
+        pass
+
+def get_inventory(tag_name, key_path, conn=None, refresh=False):
+    inventory = None if refresh else read_cache(tag_name, key_path)
+    if inventory is None:
+        inventory = build_inventory(conn or token_cache.connect(), tag_name, key_path)
+        write_cache(tag_name, key_path, inventory)
+    return inventory
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Ansible dynamic inventory for a deployment tag')
+    parser.add_argument('--list', action='store_true')
+    parser.add_argument('--host')
+    parser.add_argument('--refresh', action='store_true', help='Ignore the cache')
+    args = parser.parse_args()
+
+    tag_name = os.getenv('INVENTORY_TAG')
+    key_path = os.getenv('INVENTORY_KEY', '')
+    if not tag_name:
+        print("INVENTORY_TAG must be set to the deployment tag", file=sys.stderr)
+        sys.exit(1)
+    inventory = get_inventory(tag_name, key_path, refresh=args.refresh)
+    if args.host:
+        print(json.dumps(inventory['_meta']['hostvars'].get(args.host, {})))
+    else:
+        print(json.dumps(inventory))
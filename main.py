@@ -1,11 +1,56 @@
 import flask
-import platform
+import json
+import math
+import operator
 
 app = flask.Flask(__name__)
 
+CHUNK_SIZE = 4096
+NUMBER_TYPES = (int, float)
+
+def division(value1, value2):
+    return value1 / value2 if value2 else None
+
+OPERATIONS = {
+    'add': operator.add,
+    'sub': operator.sub,
+    'mul': operator.mul,
+    'div': division,
+}
+
+def evaluate(operation, values1, values2):
+    # One map() call per chunk keeps the per-element work inside C code.
+    for value in values1 + values2:
+        if type(value) not in NUMBER_TYPES:
+            raise ValueError(f"not a number: {value!r}")
+    return list(map(OPERATIONS[operation], values1, values2))
+
+def evaluate_prefix(operation, values1, values2):
+    # Results up to the first pair whose result does not fit in a float, and
+    # the OverflowError it raised (None if every pair was evaluated).
+    try:
+        return evaluate(operation, values1, values2), None
+    except OverflowError:
+        results = []
+        for value1, value2 in zip(values1, values2):
+            try:
+                results.append(OPERATIONS[operation](value1, value2))
+            except OverflowError as e:
+                return results, e
+        return results, None
+
+def first_non_finite(results):
+    # Overflowing floats come back as inf/nan, which JSON cannot carry.
+    for index, result in enumerate(results):
+        if type(result) is float and not math.isfinite(result):
+            return index
+    return None
+
 @app.route('/')
 def index():
-    return 'Usage;\n<Operation>?A=<Value1>&B=<Value2>\n'
+    return ('Usage;\n<Operation>?A=<Value1>&B=<Value2>\n'
+            'POST /batch {"op": "add|sub|mul|div", "A": [...], "B": [...]}\n'
+            'POST /stream?op=<add|sub|mul|div> with one [A, B] pair per line (NDJSON)\n')
 
 
 @app.route('/add')
@@ -16,5 +61,91 @@ def addition():
     return '%d \n' % result
 
 
+@app.route('/batch', methods=['POST'])
+def batch():
+    payload = flask.request.get_json(force=True, silent=True)
+    if not isinstance(payload, dict):
+        return 'Expected a JSON object\n', 400
+    operation = payload.get('op', 'add')
+    values1 = payload.get('A')
+    values2 = payload.get('B')
+    if operation not in OPERATIONS:
+        return f'Unknown operation {operation}\n', 400
+    if not isinstance(values1, list) or not isinstance(values2, list) or len(values1) != len(values2):
+        return 'A and B must be arrays of the same length\n', 400
+    result = []
+    try:
+        for start in range(0, len(values1), CHUNK_SIZE):
+            result.extend(evaluate(operation, values1[start:start + CHUNK_SIZE], values2[start:start + CHUNK_SIZE]))
+    except (ValueError, OverflowError) as e:
+        return f'{e}\n', 400
+    index = first_non_finite(result)
+    if index is not None:
+        return f'Result {index} is not a finite number: {result[index]}\n', 400
+    return flask.jsonify({'op': operation, 'result': result})
+
+
+@app.route('/stream', methods=['POST'])
+def stream():
+    operation = flask.request.args.get('op', default = 'add')
+    chunk_size = max(1, min(flask.request.args.get('chunk', default = CHUNK_SIZE, type = int), CHUNK_SIZE))
+    if operation not in OPERATIONS:
+        return f'Unknown operation {operation}\n', 400
+    input_stream = flask.request.stream
+
+    def generate():
+        # Reads the body line by line and answers every chunk_size pairs, so
+        # neither the input nor the output is ever held in memory as a whole.
+        # A bad line or result ends the stream with an error object naming the
+        # line, after the answers for every line before it.
+        values1, values2, line_numbers = [], [], []
+
+        def flush():
+            results, overflow = evaluate_prefix(operation, values1, values2)
+            index = first_non_finite(results)
+            if index is not None:
+                message = f'result is not a finite number: {results[index]}'
+            elif overflow is not None:
+                index, message = len(results), f'result is too large: {overflow}'
+            output = ''.join(json.dumps(result) + '\n' for result in results[:index])
+            if index is not None:
+                output += json.dumps({'error': message, 'line': line_numbers[index]}) + '\n'
+            return output, index is None
+
+        for line_number, line in enumerate(iter(input_stream.readline, b''), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                pair = json.loads(line)
+                if isinstance(pair, dict):
+                    pair = (pair.get('A', 0), pair.get('B', 0))
+                value1, value2 = pair
+                for value in (value1, value2):
+                    if type(value) not in NUMBER_TYPES:
+                        raise ValueError(f"not a number: {value!r}")
+            except (ValueError, TypeError) as e:
+                if values1:
+                    output, ok = flush()
+                    yield output
+                    if not ok:
+                        return
+                yield json.dumps({'error': str(e), 'line': line_number}) + '\n'
+                return
+            values1.append(value1)
+            values2.append(value2)
+            line_numbers.append(line_number)
+            if len(values1) >= chunk_size:
+                output, ok = flush()
+                yield output
+                if not ok:
+                    return
+                values1, values2, line_numbers = [], [], []
+        if values1:
+            yield flush()[0]
+
+    return flask.Response(flask.stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8211,debug=True)
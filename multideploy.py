@@ -0,0 +1,378 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import types
+import fcntl
+import argparse
+import datetime
+import functools
+import threading
+import subprocess
+import contextlib
+import concurrent.futures
+import token_cache
+import operate
+import cleanup
+from fippool import FloatingIPPool
+from tracing import span, trace_connection
+
+# Runs deploy, operate or cleanup for many tags at once, e.g.
+#
+#   multideploy.py deploy --key ~/.ssh/id_rsa --rc openrc test1 test2 test3
+#   multideploy.py cleanup --key ~/.ssh/id_rsa kna1:test1 sto2:test1
+#
+# "cloud:tag" picks a cloud from clouds.yaml, a bare tag uses the OS_*
+# variables. Tags on the same cloud share one authenticated connection and
+# its HTTP pool, all API calls to a cloud go through one rate limit, and each
+# tag works in its own directory under --output so their files never mix.
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+MULTI_WORKERS = int(os.getenv('MULTI_WORKERS', '4'))
+# Requests per second and burst, per cloud
+API_RATE = float(os.getenv('MULTI_API_RATE', '10'))
+API_BURST = int(os.getenv('MULTI_API_BURST', '20'))
+
+def log(message):
+    # stdout belongs to the flows, see TagOutput
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{timestamp} {message}", file=sys.stderr)
+
+class TagOutput:
+    # Stands in for sys.stdout: whatever a tag's thread prints goes to that
+    # tag's log file instead of interleaving with the other tags. The flows'
+    # own worker threads are not tied to a tag and write to the shared stream.
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        return (getattr(self.local, 'file', None) or self.stream).write(text)
+
+    def flush(self):
+        (getattr(self.local, 'file', None) or self.stream).flush()
+
+    @contextlib.contextmanager
+    def to(self, path):
+        with open(path, 'a') as f:
+            self.local.file = f
+            try:
+                yield
+            finally:
+                self.local.file = None
+
+def load_deploy():
+    # scripts/Deploy.py is instances.py followed by servers.py
+    try:
+        import Deploy
+        return Deploy
+    except ImportError:
+        pass
+    source = ''
+    for name in ('instances.py', 'servers.py'):
+        with open(os.path.join(BASEDIR, name)) as f:
+            source += f.read() + '\n'
+    module = types.ModuleType('Deploy')
+    module.__file__ = os.path.join(BASEDIR, 'Deploy.py')
+    exec(compile(source, module.__file__, 'exec'), module.__dict__)
+    return module
+
+def script_path(*names):
+    for name in names:
+        for path in (os.path.join(BASEDIR, name), os.path.join(BASEDIR, 'scripts', name)):
+            if os.path.exists(path):
+                return path
+    raise FileNotFoundError(f"none of {', '.join(names)} next to {BASEDIR}")
+
+class RateLimiter:
+    # Token bucket shared by every thread that talks to one cloud.
+    def __init__(self, rate=API_RATE, burst=API_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.waited = 0.0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.calls += 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+                self.waited += delay
+            time.sleep(delay)
+
+class RateLimitedProxy:
+    # Same shape as TracedProxy: every call on conn.compute or conn.network
+    # takes a token first. A paginated listing counts as one call.
+    def __init__(self, proxy, limiter):
+        self._proxy = proxy
+        self._limiter = limiter
+
+    def __getattr__(self, attribute):
+        value = getattr(self._proxy, attribute)
+        if attribute.startswith('_') or not callable(value):
+            return value
+
+        @functools.wraps(value)
+        def call(*args, **kwargs):
+            self._limiter.acquire()
+            return value(*args, **kwargs)
+        return call
+
+class RateLimitedConnection:
+    def __init__(self, conn, limiter):
+        self._conn = conn
+        self.limiter = limiter
+        self.compute = RateLimitedProxy(conn.compute, limiter)
+        self.network = RateLimitedProxy(conn.network, limiter)
+
+    def __getattr__(self, attribute):
+        return getattr(self._conn, attribute)
+
+def widen_pool(conn, size):
+    # requests keeps 10 connections per host by default, the tags would queue
+    # for them. keystoneauth exposes the underlying requests session.
+    session = getattr(getattr(conn, 'session', None), 'session', None)
+    if session is None:
+        return
+    import requests.adapters
+    adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+def parse_target(target):
+    cloud, _, tag_name = target.rpartition(':')
+    return cloud or None, tag_name
+
+def target_directory(output, cloud, tag_name):
+    return os.path.join(output, f"{cloud}_{tag_name}" if cloud else tag_name)
+
+@contextlib.contextmanager
+def tag_lock(directory):
+    # One flow per tag at a time, across threads and across driver processes.
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class Progress:
+    def __init__(self, targets):
+        self.total = len(targets)
+        self.done = 0
+        self.lock = threading.Lock()
+        # target -> {'status', 'phases': [(name, seconds)], 'error', 'wall_s'}
+        self.results = {target: {'status': 'pending', 'phases': []} for target in targets}
+
+    @contextlib.contextmanager
+    def phase(self, target, name):
+        log(f"[{target}] {name}...")
+        start = time.perf_counter()
+        try:
+            with span(f"{name} {target}"):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.results[target]['phases'].append((name, round(elapsed, 3)))
+            log(f"[{target}] {name} took {elapsed:.1f}s")
+
+    def finish(self, target, elapsed, error=None):
+        with self.lock:
+            self.done += 1
+            result = self.results[target]
+            result['status'] = 'failed' if error else 'ok'
+            result['wall_s'] = round(elapsed, 3)
+            if error:
+                result['error'] = error
+            done = self.done
+        log(f"[{target}] {result['status']} after {elapsed:.1f}s ({done}/{self.total} done)")
+
+class Driver:
+    def __init__(self, action, targets, key_path, output, workers=MULTI_WORKERS, rate=API_RATE, burst=API_BURST,
+                 dev_servers=None, configure=True, release_floating_ips=False):
+        self.action = action
+        self.targets = targets
+        self.key_path = os.path.abspath(key_path)
+        self.output = os.path.abspath(output)
+        os.makedirs(self.output, exist_ok=True)
+        self.workers = workers
+        self.rate = rate
+        self.burst = burst
+        self.dev_servers = dev_servers
+        self.configure_hosts = configure
+        self.release_floating_ips = release_floating_ips
+        self.deploy = load_deploy()
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+        self.fip_pools = {}
+        self.fip_pools_lock = threading.Lock()
+        self.progress = Progress(targets)
+
+    def connection(self, cloud):
+        # One authenticated session per cloud, shared by all of its tags.
+        with self.connections_lock:
+            if cloud not in self.connections:
+                with span('connect', 'api', cloud=cloud or 'environment'):
+                    conn = token_cache.connect(cloud=cloud) if cloud else self.deploy.connect_to_openstack()
+                widen_pool(conn, self.workers * self.deploy.PROVISION_WORKERS)
+                self.connections[cloud] = trace_connection(RateLimitedConnection(conn, RateLimiter(self.rate, self.burst)))
+            return self.connections[cloud]
+
+    def fip_pool(self, cloud):
+        # Free floating IPs are project-wide, so the tags of a cloud take them
+        # from one pool; a pool per tag would hand the same address to both.
+        with self.fip_pools_lock:
+            if cloud not in self.fip_pools:
+                self.fip_pools[cloud] = FloatingIPPool(self.connection(cloud))
+            return self.fip_pools[cloud]
+
+    def environment(self, cloud, tag_name, directory):
+        # The tag's SSH config is in its directory, and so is everything
+        # Ansible keeps under HOME.
+        env = dict(os.environ, HOME=directory, INVENTORY_TAG=tag_name, INVENTORY_KEY=self.key_path)
+        if cloud:
+            env['OS_CLOUD'] = cloud
+        return env
+
+    def run_script(self, target, name, command, directory, env):
+        with self.progress.phase(target, name):
+            process = subprocess.run(command, cwd=directory, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        print(process.stdout.decode(), end='')
+        if process.returncode != 0:
+            raise Exception(f"{name} exited with {process.returncode}, see {directory}/{self.action}.log")
+        return process.stdout.decode()
+
+    def configure(self, target, cloud, tag_name, directory):
+        # Same steps as install after Deploy.py, inside the tag's directory.
+        env = self.environment(cloud, tag_name, directory)
+        if not self.configure_hosts:
+            return
+        self.run_script(target, 'ssh readiness', [sys.executable, script_path('readiness.py'), '-i', 'hosts'], directory, env)
+        self.run_script(target, 'ansible', [sys.executable, script_path('playbook.py'), '--inventory', 'hosts', '--playbook', script_path('site.yaml')], directory, env)
+
+    def run_deploy(self, target, cloud, tag_name, directory):
+        conn = self.connection(cloud)
+        with self.progress.phase(target, 'servers'):
+            self.deploy.main(None, tag_name, self.key_path, conn=conn, directory=directory, dev_servers=self.dev_servers, fip_pool=self.fip_pool(cloud))
+        # Deploy.main wrote the config files already.
+        self.configure(target, cloud, tag_name, directory)
+
+    def run_operate(self, target, cloud, tag_name, directory):
+        # One reconcile pass: bring the dev server count to --dev-servers,
+        # then reconfigure if the servers moved since the last applied run.
+        conn = self.connection(cloud)
+        state_file = os.path.join(directory, operate.state.STATE_FILE)
+        required = self.deploy.DEV_SERVERS if self.dev_servers is None else self.dev_servers
+        with self.progress.phase(target, 'servers'):
+            dev_servers = operate.list_dev_servers(conn, tag_name)
+            if len(dev_servers) != required:
+                network, subnet, router, security_group, keypair_name = operate.get_network_parameters(conn, tag_name)
+                try:
+                    hosts = operate.load_hosts(os.path.join(directory, 'hosts'))
+                except (OSError, KeyError, ValueError):
+                    hosts = None
+                created = operate.manage_dev_servers(conn, dev_servers.values(), tag_name, keypair_name, network, security_group, required, hosts)
+                operate.invalidate_inventory_cache(os.path.join(directory, self.deploy.INVENTORY_CACHE_FILE))
+                operate.wait_for_new_servers(conn, created)
+                dev_servers = operate.list_dev_servers(conn, tag_name)
+        fingerprint = operate.dev_server_fingerprint(dev_servers)
+        if fingerprint == (operate.state.get(tag_name, state_file) or {}).get('applied'):
+            log(f"[{target}] converged, nothing to apply.")
+            return
+        with self.progress.phase(target, 'configs'):
+            operate.configfiles.main(tag_name, self.key_path, conn, directory)
+        self.configure(target, cloud, tag_name, directory)
+        operate.state.update(tag_name, file_path=state_file, applied=fingerprint)
+
+    def run_cleanup(self, target, cloud, tag_name, directory):
+        conn = self.connection(cloud)
+        with self.progress.phase(target, 'teardown'):
+            cleanup.cleanup_instances(conn, tag_name, self.release_floating_ips, directory)
+
+    def run_target(self, target):
+        cloud, tag_name = parse_target(target)
+        directory = target_directory(self.output, cloud, tag_name)
+        start = time.perf_counter()
+        error = None
+        try:
+            with tag_lock(directory), self.output_stream.to(os.path.join(directory, f"{self.action}.log")):
+                getattr(self, f"run_{self.action}")(target, cloud, tag_name, directory)
+        except Exception as e:
+            error = str(e)
+            log(f"[{target}] {self.action} failed: {e}")
+        self.progress.finish(target, time.perf_counter() - start, error)
+
+    def run(self):
+        log(f"{self.action} for {len(self.targets)} tags, {self.workers} at a time.")
+        start = time.perf_counter()
+        stdout = sys.stdout
+        with open(os.path.join(self.output, f"{self.action}.log"), 'a') as shared:
+            sys.stdout = self.output_stream = TagOutput(shared)
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    list(executor.map(self.run_target, self.targets))
+            finally:
+                sys.stdout = stdout
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        clouds = {}
+        for cloud, conn in self.connections.items():
+            limiter = conn.limiter
+            clouds[cloud or 'environment'] = {'api_calls': limiter.calls, 'rate_limited_s': round(limiter.waited, 3)}
+        report = {
+            'action': self.action,
+            'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'wall_s': round(elapsed, 3),
+            'workers': self.workers,
+            'clouds': clouds,
+            'targets': self.progress.results,
+        }
+        with open(os.path.join(self.output, 'report.json'), 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"\n{'target':30} {'status':8} {'wall':>8}  phases")
+        for target, result in self.progress.results.items():
+            phases = ', '.join(f"{name} {seconds}s" for name, seconds in result['phases'])
+            print(f"{target:30} {result['status']:8} {result.get('wall_s', 0):>7}s  {phases}")
+        for cloud, counts in clouds.items():
+            print(f"{cloud}: {counts['api_calls']} API calls, {counts['rate_limited_s']}s spent waiting on the rate limit (summed over threads)")
+        print(f"Total {elapsed:.1f}s, report in {os.path.join(self.output, 'report.json')}")
+        return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Deploy, operate or clean up several tags concurrently')
+    parser.add_argument('action', choices=['deploy', 'operate', 'cleanup'])
+    parser.add_argument('targets', nargs='+', help='tag or cloud:tag (cloud from clouds.yaml)')
+    parser.add_argument('--key', required=True, help='Private key for the servers')
+    parser.add_argument('--rc', help='OpenStack RC file for the targets without a cloud')
+    parser.add_argument('--output', default='deployments', help='One directory per tag goes here')
+    parser.add_argument('--workers', type=int, default=MULTI_WORKERS, help='Tags handled at once')
+    parser.add_argument('--rate', type=float, default=API_RATE, help='API calls per second per cloud')
+    parser.add_argument('--burst', type=int, default=API_BURST)
+    parser.add_argument('--dev-servers', type=int, help='Dev servers per tag (deploy and operate)')
+    parser.add_argument('--skip-ansible', action='store_true', help='Stop after the servers and config files')
+    parser.add_argument('--release-floating-ips', action='store_true')
+    args = parser.parse_args()
+
+    if args.rc:
+        with open(args.rc) as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    key, value = line.split('=', 1)
+                    os.environ[key.strip()] = value.strip()
+    driver = Driver(args.action, list(dict.fromkeys(args.targets)), args.key, args.output, args.workers, args.rate, args.burst,
+                    args.dev_servers, not args.skip_ansible, args.release_floating_ips)
+    report = driver.run()
+    sys.exit(1 if any(result['status'] != 'ok' for result in report['targets'].values()) else 0)
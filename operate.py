@@ -1,25 +1,107 @@
 #!/usr/bin/python3
 
+import os
 import sys
 import time
+import ctypes
+import ctypes.util
+import select
+import struct
 import datetime
-import openstack
 import subprocess
+from playbook import run_playbook, INVENTORY
+from readiness import load_hosts, wait_for_ssh
+from haproxy_runtime import sync_backends
+from autoscale import Autoscaler, SignalCollector, read_servers_conf, AUTOSCALE_INTERVAL
+from inventory import invalidate_cache as invalidate_inventory_cache
+from tracing import span, traced, trace_connection
+from cloudinit import dev_server_user_data
+from waiter import ServerWaiter, is_network_ready
+from devservers import free_indexes, internal_ip, list_dev_servers, remove_dev_servers
+import state
+import token_cache
+try:
+    import gen_config as configfiles
+except ImportError:
+    import configfiles
+
+RESYNC_INTERVAL = int(os.getenv('OPERATE_RESYNC_INTERVAL', '60'))
+MTIME_POLL_INTERVAL = 1
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
 
 def run_command(command):
-    result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with span(' '.join(command.split()[:2]), 'subprocess', command=command):
+        result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     return result.stdout.decode().strip(), result.stderr.decode().strip()
 
 def connect_to_openstack():
-    return openstack.connect()
+    with span('connect', 'api'):
+        return trace_connection(token_cache.connect())
 
 def log(message):
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     print(f"{timestamp} {message}")
 
-def read_required_servers(file_path):
-    with open(file_path, 'r') as file:
-        return int(file.read().strip())
+class ConfigWatcher:
+    # Blocks until servers.conf changes. Uses inotify on the parent directory so
+    # editors that replace the file are seen too, and falls back to polling the
+    # mtime once a second where inotify is not available.
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.mtime = self.current_mtime()
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            if libc.inotify_add_watch(fd, os.path.dirname(self.path).encode(), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.fd = fd
+        except (OSError, AttributeError, TypeError) as e:
+            log(f"inotify unavailable ({e}), polling {self.path} for changes.")
+
+    def current_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def drain_events(self):
+        names = set()
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + 16 <= len(data):
+            _, _, _, length = struct.unpack_from('iIII', data, offset)
+            names.add(data[offset + 16:offset + 16 + length].rstrip(b'\0').decode())
+            offset += 16 + length
+        return names
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.fd is not None:
+                ready, _, _ = select.select([self.fd], [], [], remaining)
+                if not ready or os.path.basename(self.path) not in self.drain_events():
+                    continue
+            else:
+                time.sleep(min(MTIME_POLL_INTERVAL, remaining))
+            mtime = self.current_mtime()
+            if mtime != self.mtime:
+                self.mtime = mtime
+                return True
 
 def get_network_parameters(conn, tag_name):
     network_name = f"{tag_name}_network"
@@ -35,68 +117,96 @@ def get_network_parameters(conn, tag_name):
 
     return network, subnet, router, security_group, keypair_name
 
-def manage_dev_servers(conn, existing_servers, tag_name, keypair_name, network, security_group, required_dev_servers):
+@traced()
+def manage_dev_servers(conn, existing_servers, tag_name, keypair_name, network, security_group, required_dev_servers, hosts=None):
     dev_server_prefix = f"{tag_name}_dev"
     
-    if not existing_servers:
-        log("No servers retrieved from OpenStack. Please check the connection and server details.")
-        return
-    existing_servers = list(existing_servers)  # Ensure it is a list
-    devservers_count = len([server for server in existing_servers if server.name.startswith(dev_server_prefix)])
+    dev_servers = [server for server in existing_servers if server.name.startswith(dev_server_prefix)]
+    devservers_count = len(dev_servers)
+    created = []
     log(f"Current number of dev servers: {devservers_count}")
     
     if required_dev_servers > devservers_count:
         devservers_to_add = required_dev_servers - devservers_count
         log(f"Need to add {devservers_to_add} dev servers.")
-        
-
-        for i in range(devservers_count + 1, devservers_count + devservers_to_add + 1):
+        user_data = dev_server_user_data()
+        # Reuse the indexes freed by earlier scale-downs.
+        for i in free_indexes(dev_servers, dev_server_prefix, devservers_to_add):
             devserver_name = f"{dev_server_prefix}{i}"
             log(f"Creating server {devserver_name}...")
-            conn.compute.create_server(
+            created.append(conn.compute.create_server(
                 name=devserver_name,image_id=conn.compute.find_image('Ubuntu 20.04 Focal Fossa x86_64').id,flavor_id=conn.compute.find_flavor('1C-2GB-50GB').id,networks=[{"uuid": network.id}],
-                security_groups=[{"name": security_group.name}],key_name=keypair_name
-            )
+                security_groups=[{"name": security_group.name}],key_name=keypair_name,user_data=user_data
+            ))
             log(f"Server {devserver_name} created successfully.")
     
     elif required_dev_servers < devservers_count:
         devservers_to_remove = devservers_count - required_dev_servers
         log(f"Need to remove {devservers_to_remove} dev servers.")
+        remove_dev_servers(conn, tag_name, dev_servers, devservers_to_remove, hosts)
 
-        for server in existing_servers:
-            log(f"Checking server {server.name} for deletion criteria...")
-            if server.name.startswith(dev_server_prefix) and devservers_to_remove > 0:
-                log(f"Attempting to delete server {server.name}...")
-                try:
-                    conn.compute.delete_server(server.id)
-                    log(f"Server {server.name} deleted successfully.")
-                    devservers_to_remove -= 1
-                    existing_servers = list(conn.compute.servers(details=True))  # Refresh server list after deletion
-                except Exception as e:
-                    log(f"Failed to delete server {server.name}: {e}")
-                
     else:
         log(f"Required number of dev servers ({required_dev_servers}) already exist. No action needed.")
+    return created
 
 
-def generate_configs(tag_name, private_key):
+@traced()
+def generate_configs(conn, tag_name, private_key):
+    # In-process on the loop's connection: no interpreter start or login per cycle.
     print("Generating Configuration files.")
     try:
-        output = run_command(f"python3 gen_config.py {tag_name} {private_key}")
-        if "No such file or directory" in output[1]:
-            raise FileNotFoundError
-    except FileNotFoundError:
-        output = run_command(f"python3 scripts/gen_config.py {tag_name} {private_key}")
+        return configfiles.main(tag_name, private_key, conn)
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         return None
-    print(output)
-    return output
 
-def run_ansible_playbook():
+@traced(kind='subprocess')
+def run_ansible_playbook(full=False, backends_synced=False):
     print("Running Ansible playbook...")
-    ansible_command = "ansible-playbook -i hosts scripts/site.yaml"
-    subprocess.run(ansible_command, shell=True)
+    return run_playbook(full=full, backends_synced=backends_synced)
+
+def dev_server_fingerprint(dev_servers):
+    return state.fingerprint(sorted((name, server.status, str(server.addresses)) for name, server in dev_servers.items()))
+
+@traced(kind='wait')
+def wait_for_new_servers(conn, servers):
+    for server in ServerWaiter(conn, is_network_ready).as_ready(servers):
+        log(f"Server {server.name} is up at {internal_ip(server)}.")
+
+@traced()
+def reconcile(conn, tag_name, private_key, required_dev_servers, applied):
+    # applied is the dev server fingerprint the last successful Ansible run saw;
+    # config generation and Ansible only run when the actual state moved away from it.
+    dev_servers = list_dev_servers(conn, tag_name)
+    if len(dev_servers) != required_dev_servers:
+        log(f"Dev servers: {len(dev_servers)} running, {required_dev_servers} required.")
+        network, subnet, router, security_group, keypair_name = get_network_parameters(conn, tag_name)
+        try:
+            hosts = load_hosts(INVENTORY)
+        except (OSError, KeyError, ValueError):
+            hosts = None
+        created = manage_dev_servers(conn, dev_servers.values(), tag_name, keypair_name, network, security_group, required_dev_servers, hosts)
+        invalidate_inventory_cache()
+        wait_for_new_servers(conn, created)
+        dev_servers = list_dev_servers(conn, tag_name)
+    fingerprint = dev_server_fingerprint(dev_servers)
+    if fingerprint == applied:
+        return applied
+    changed = generate_configs(conn, tag_name, private_key)
+    if applied is not None and changed is False:
+        log("Inventory and SSH config unchanged, skipping Ansible.")
+        return fingerprint
+    hosts = load_hosts(INVENTORY)
+    not_ready = sorted(name for name, (ready, _) in wait_for_ssh(hosts).items() if not ready)
+    if not_ready:
+        log(f"Hosts not accepting SSH: {', '.join(not_ready)}, will retry on the next change or resync.")
+        return applied
+    # Hitless path first, Ansible re-renders haproxy.cfg only if a proxy ran out of slots.
+    backends_synced = applied is not None and sync_backends(hosts)
+    if run_ansible_playbook(backends_synced=backends_synced) != 0:
+        log("Ansible playbook failed, will retry on the next change or resync.")
+        return applied
+    return fingerprint
 
 
 if __name__ == "__main__":
@@ -107,22 +217,46 @@ if __name__ == "__main__":
     source_of_rcfile = sys.argv[1]
     tag_name = sys.argv[2]
     private_key = sys.argv[3]
+    # Picked up by inventory.py when Ansible runs with the dynamic inventory
+    os.environ.setdefault('INVENTORY_TAG', tag_name)
+    os.environ.setdefault('INVENTORY_KEY', private_key)
     conn = connect_to_openstack()
+    servers_conf = 'configurations/servers.conf'
+    if not os.path.exists(servers_conf):
+        servers_conf = 'scripts/servers.conf'
+    watcher = ConfigWatcher(servers_conf)
+    # A restart picks up where the last run left off: if nothing moved since,
+    # the first cycle is a single list call.
+    applied = (state.get(tag_name) or {}).get('applied')
+    required_dev_servers = None
+    mode = None
+    autoscaler = None
+    collector = SignalCollector()
     while True:
         try:
-            required_dev_servers = read_required_servers('configurations/servers.conf')
-        except FileNotFoundError:
-            required_dev_servers = read_required_servers('scripts/servers.conf')
-        log(f"Required number of dev servers: {required_dev_servers}")
-        
-        existing_servers = conn.compute.servers(details=True) 
-        network, subnet, router, security_group, keypair_name = get_network_parameters(conn, tag_name)        
-        manage_dev_servers(conn, existing_servers, tag_name, keypair_name, network, security_group, required_dev_servers)
-        print ("Sleeping for 30 seconds.")
-        time.sleep(30)
-        generate_configs(tag_name, private_key)
-        print("sleeping for 30 seconds...")        
-        time.sleep(30)
-        run_ansible_playbook()
-        log("Sleeping for 30 seconds...")
-        time.sleep(30)
+            mode, setting = read_servers_conf(servers_conf)
+        except ValueError:
+            log(f"Could not parse {servers_conf}, keeping {required_dev_servers} dev servers.")
+        if mode == 'auto':
+            if autoscaler is None or (autoscaler.minimum, autoscaler.maximum) != tuple(setting):
+                log(f"Autoscaling between {setting[0]} and {setting[1]} dev servers.")
+                autoscaler = Autoscaler(*setting)
+            try:
+                signals = collector.collect(load_hosts(INVENTORY))
+            except Exception as e:
+                log(f"Could not collect load signals: {e}")
+                signals = {}
+            current = len(list_dev_servers(conn, tag_name))
+            required_dev_servers = autoscaler.decide(current, signals)
+            log(f"Signals: cpu {signals.get('cpu')}, rate {signals.get('rate')}, queue {signals.get('queue')}; {current} -> {required_dev_servers} dev servers.")
+        elif mode == 'manual':
+            autoscaler = None
+            required_dev_servers = setting
+        if required_dev_servers is not None:
+            log(f"Required number of dev servers: {required_dev_servers}")
+            previous = applied
+            applied = reconcile(conn, tag_name, private_key, required_dev_servers, applied)
+            if applied != previous:
+                state.update(tag_name, applied=applied)
+        if watcher.wait(AUTOSCALE_INTERVAL if mode == 'auto' else RESYNC_INTERVAL):
+            log(f"{servers_conf} changed.")
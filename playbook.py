@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import argparse
+import datetime
+import subprocess
+from tracing import span
+
+INVENTORY = os.getenv('ANSIBLE_INVENTORY_SOURCE', 'hosts')
+PLAYBOOK = 'scripts/site.yaml'
+STATE_FILE = '.ansible_hosts_state.json'
+PROXY_GROUPS = ('main_proxy', 'standby_proxy')
+FACT_CACHE_DIR = '.ansible_facts'
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{timestamp} {message}")
+
+def read_dynamic_inventory():
+    from inventory import get_inventory
+    inventory = get_inventory(os.environ['INVENTORY_TAG'], os.getenv('INVENTORY_KEY', ''))
+    hostvars = inventory['_meta']['hostvars']
+    return {host: {'group': group, 'line': json.dumps(hostvars.get(host, {}), sort_keys=True)}
+            for group, value in inventory.items() if group != '_meta' for host in value['hosts']}
+
+def read_inventory(file_path):
+    if file_path.endswith('.py'):
+        return read_dynamic_inventory()
+    hosts = {}
+    group = None
+    with open(file_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                group = line[1:-1]
+                continue
+            if group is None or ':' in group:
+                continue
+            hosts[line.split()[0]] = {'group': group, 'line': line}
+    return hosts
+
+def load_state(file_path=STATE_FILE):
+    try:
+        with open(file_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def save_state(hosts, file_path=STATE_FILE):
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(hosts, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, file_path)
+
+def forget_facts(hosts, cache_dir=FACT_CACHE_DIR):
+    # A rebuilt server keeps its name but not its addresses, drop its cached facts.
+    for host in hosts:
+        try:
+            os.remove(os.path.join(cache_dir, host))
+        except FileNotFoundError:
+            pass
+
+def plan_runs(current, previous, inventory, playbook, backends_synced=False):
+    base = ['ansible-playbook', '-i', inventory, playbook]
+    if previous is None:
+        return [base]
+    changed = sorted(host for host in current if previous.get(host) != current[host])
+    removed = sorted(host for host in previous if host not in current)
+    if not changed and not removed:
+        return []
+    if any(current[host]['group'] != 'devservers' for host in changed):
+        # Bastion or proxy entries moved, everything downstream depends on them.
+        return [base]
+    runs = []
+    if changed:
+        log(f"New or changed dev servers: {', '.join(changed)}")
+        runs.append(base + ['--limit', ','.join(changed), '--tags', 'node_exporter,devservers'])
+    if removed:
+        log(f"Removed hosts: {', '.join(removed)}")
+    proxies = sorted(host for host in current if current[host]['group'] in PROXY_GROUPS)
+    if backends_synced:
+        log("Proxy backends already updated through the runtime API.")
+    elif proxies:
+        runs.append(base + ['--limit', ','.join(proxies), '--tags', 'haproxy_backends'])
+    return runs
+
+def run_playbook(full=False, inventory=INVENTORY, playbook=PLAYBOOK, state_file=STATE_FILE, backends_synced=False):
+    full = full or os.getenv('ANSIBLE_FULL_RUN') == '1'
+    current = read_inventory(inventory)
+    previous = None if full else load_state(state_file)
+    runs = plan_runs(current, previous, inventory, playbook, backends_synced)
+    forget_facts(host for host in set(current) | set(previous or {}) if (previous or {}).get(host) != current.get(host))
+    if not runs:
+        if previous != current:
+            save_state(current, state_file)
+        log("Nothing to converge since the last successful run, skipping Ansible.")
+        return 0
+    for command in runs:
+        log(f"Running {' '.join(command)}")
+        with span('ansible-playbook', 'subprocess', command=' '.join(command)):
+            returncode = subprocess.run(command).returncode
+        if returncode != 0:
+            return returncode
+    save_state(current, state_file)
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--full', action='store_true', help='Run every play on every host')
+    parser.add_argument('--inventory', default=INVENTORY)
+    parser.add_argument('--playbook', default=PLAYBOOK)
+    args = parser.parse_args()
+    sys.exit(run_playbook(args.full, args.inventory, args.playbook))
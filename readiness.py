@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+import os
+import sys
+import time
+import shlex
+import random
+import select
+import socket
+import argparse
+import datetime
+import threading
+import subprocess
+import concurrent.futures
+from tracing import span, traced
+
+INVENTORY = os.getenv('ANSIBLE_INVENTORY_SOURCE', 'hosts')
+READY_TIMEOUT = int(os.getenv('SSH_READY_TIMEOUT', '300'))
+CONNECT_TIMEOUT = 5
+INITIAL_DELAY = 0.5
+MAX_DELAY = 8
+SSH_OPTIONS = ['-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+               '-o', 'LogLevel=ERROR', '-o', f'ConnectTimeout={CONNECT_TIMEOUT}',
+               '-o', 'ControlMaster=auto', '-o', 'ControlPath=~/.ssh/readiness-%r@%h:%p', '-o', 'ControlPersist=60']
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{timestamp} {message}")
+
+def load_hosts(file_path=INVENTORY):
+    # host -> hostvars, from the static hosts file or the dynamic inventory
+    if file_path.endswith('.py'):
+        from inventory import get_inventory
+        return get_inventory(os.environ['INVENTORY_TAG'], os.getenv('INVENTORY_KEY', ''))['_meta']['hostvars']
+    hosts = {}
+    with open(file_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith('['):
+                continue
+            name, *variables = shlex.split(line)
+            hosts[name] = dict(variable.split('=', 1) for variable in variables if '=' in variable)
+    return hosts
+
+def jump_host(hostvars):
+    # "-o ProxyJump=ubuntu@1.2.3.4 -i key" -> ('ubuntu@1.2.3.4', 'key')
+    arguments = shlex.split(hostvars.get('ansible_ssh_common_args', ''))
+    target, key_path = None, hostvars.get('ansible_ssh_private_key_file')
+    for index, argument in enumerate(arguments):
+        if argument.startswith('ProxyJump='):
+            target = argument.split('=', 1)[1]
+        elif argument == '-i' and index + 1 < len(arguments):
+            key_path = arguments[index + 1]
+    return target, key_path
+
+def read_banner(address, port=22):
+    try:
+        with socket.create_connection((address, port), timeout=CONNECT_TIMEOUT) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            return sock.recv(256).startswith(b'SSH-')
+    except OSError:
+        return False
+
+def read_banner_via(jump, key_path, address, port=22):
+    # ssh -W forwards stdin/stdout to address:port from the bastion, so the
+    # first bytes on stdout are the target's banner. The control socket keeps
+    # one bastion session for all the probes.
+    command = ['ssh'] + (['-i', key_path] if key_path else []) + SSH_OPTIONS + ['-W', f'{address}:{port}', jump]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        readable, _, _ = select.select([process.stdout], [], [], CONNECT_TIMEOUT * 2)
+        return bool(readable) and process.stdout.read1(256).startswith(b'SSH-')
+    finally:
+        process.kill()
+        process.wait()
+
+def probe_until_ready(probe, deadline):
+    # Backoff grows while the host is down and is jittered so the hosts of one
+    # deployment do not retry in lockstep.
+    delay = INITIAL_DELAY
+    attempts = 0
+    while True:
+        attempts += 1
+        if probe():
+            return True, attempts
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False, attempts
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(delay * 2, MAX_DELAY)
+
+@traced(kind='wait')
+def wait_for_ssh(hosts, timeout=READY_TIMEOUT):
+    # hosts is name -> hostvars. Hosts behind a ProxyJump are only probed once
+    # their jump host answers. Returns name -> (ready, seconds).
+    started = time.monotonic()
+    deadline = started + timeout
+    jump_failed = set()
+    # Only jump hosts that are probed here are waited for, e.g. not with --limit.
+    addresses = {address for name, hostvars in hosts.items()
+                 for address in (f"{hostvars.get('ansible_user', 'ubuntu')}@{hostvars.get('ansible_host', name)}", hostvars.get('ansible_host', name))}
+    jump_ready = {target: threading.Event() for target in (jump_host(hostvars)[0] for hostvars in hosts.values()) if target in addresses}
+
+    def check(name, hostvars):
+        address = hostvars.get('ansible_host', name)
+        target, key_path = jump_host(hostvars)
+        with span('ssh ready', 'wait', host=name):
+            if target:
+                if target in jump_ready:
+                    jump_ready[target].wait(max(0, deadline - time.monotonic()))
+                if target in jump_failed or (target in jump_ready and not jump_ready[target].is_set()):
+                    # Nothing behind an unreachable jump host can come up either.
+                    ready, attempts = False, 0
+                else:
+                    ready, attempts = probe_until_ready(lambda: read_banner_via(target, key_path, address), deadline)
+            else:
+                ready, attempts = probe_until_ready(lambda: read_banner(address), deadline)
+        elapsed = time.monotonic() - started
+        if ready:
+            log(f"{name} ({address}) accepts SSH after {elapsed:.1f}s, {attempts} attempts.")
+        else:
+            log(f"{name} ({address}) not reachable over SSH after {elapsed:.1f}s.")
+        for jump in (f"{hostvars.get('ansible_user', 'ubuntu')}@{address}", address):
+            if jump in jump_ready:
+                if not ready:
+                    jump_failed.add(jump)
+                jump_ready[jump].set()
+        return name, ready, elapsed
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(hosts))) as executor:
+        futures = [executor.submit(check, name, hostvars) for name, hostvars in hosts.items()]
+        for future in concurrent.futures.as_completed(futures):
+            name, ready, elapsed = future.result()
+            results[name] = (ready, round(elapsed, 2))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Wait until every inventory host accepts SSH')
+    parser.add_argument('-i', '--inventory', default=INVENTORY)
+    parser.add_argument('--timeout', type=int, default=READY_TIMEOUT, help='Per-host deadline in seconds')
+    parser.add_argument('--limit', nargs='*', help='Only these hosts')
+    args = parser.parse_args()
+
+    hosts = load_hosts(args.inventory)
+    if args.limit:
+        hosts = {name: hostvars for name, hostvars in hosts.items() if name in args.limit}
+    results = wait_for_ssh(hosts, args.timeout)
+    missing = sorted(name for name, (ready, _) in results.items() if not ready)
+    if missing:
+        log(f"Hosts not ready: {', '.join(missing)}")
+        sys.exit(1)
+    log(f"All {len(results)} hosts accept SSH.")
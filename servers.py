@@ -1,96 +1,118 @@
-def create_servers(conn, server_name, port_name, image_id, flavor_id, keypair_name, security_group_id, network_id, floating_ip_required,existing_servers): 
-    if server_name in existing_servers:
-        server = conn.compute.find_server(server_name)
-        port = conn.network.find_port(port_name)
-        fip = get_floating_ip(server.addresses) if floating_ip_required else None
-        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Server {server_name} already exists. {fip}, {port_name}")
-        return server, fip
+def launch_server(conn, server_name, port_name, image_id, flavor_id, keypair_name, security_group_id, network_id, user_data=None):
+    port = conn.network.create_port(name=port_name, network_id=network_id,security_groups=[security_group_id])
+    print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Created port {port.name} with ID {port.id}.")
+    server = conn.compute.create_server(name=server_name, image_id=image_id, flavor_id=flavor_id, key_name=keypair_name,networks=[{"port": port.id}], user_data=user_data)
+    return server, port
+
+def finish_server(snapshot, fip_pool, server, port, floating_ip_required):
+    server = snapshot.add('server', server)
+    # Nova binds the port on boot, record that locally instead of re-reading the port.
+    port.device_id = server.id
+    snapshot.update('port', port)
+    print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Server {server.name}")
+    applied_security_groups = [sg['name'] for sg in server.security_groups]
+    print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Applied security groups: {applied_security_groups}")
+
+    if floating_ip_required:
+        _, _, fip = associate_floating_ip(snapshot, fip_pool, server.name)
+        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Server {server.name} assigned floating IP {fip}.")
     else:
-        port = conn.network.create_port(name=port_name, network_id=network_id,security_groups=[security_group_id])
-        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Created port {port.name} with ID {port.id}.")
-        server = conn.compute.create_server(name=server_name, image_id=image_id, flavor_id=flavor_id, key_name=keypair_name,networks=[{"port": port.id}])
-        server = conn.compute.wait_for_server(server)
-        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Server {server.name}")
-        applied_security_groups = [sg['name'] for sg in server.security_groups]
-        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Applied security groups: {applied_security_groups}")
-
-        if floating_ip_required:
-            fip_tuple = create_floating_ip(conn, "ext-net")
-            associate_floating_ip(conn, server_name, fip_tuple)
-            fip = fip_tuple[2]
-            print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Server {server.name} assigned floating IP {fip}.")
+        fip = None
+    return server, fip
+
+@traced()
+def create_servers(conn, snapshot, fip_pool, servers, image_id, flavor_id, keypair_name, security_group_id, network_id, existing_servers, executor):
+    # servers is a list of (server_name, port_name, floating_ip_required, user_data).
+    # Everything boots at once, then one waiter polls the whole batch and hands
+    # each server to its floating IP step as soon as it is ACTIVE.
+    results = {}
+    launches = {}
+    for server_name, port_name, floating_ip_required, user_data in servers:
+        if server_name in existing_servers:
+            server = existing_servers[server_name]
+            fip = get_floating_ip(server.addresses) if floating_ip_required else None
+            print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Server {server_name} already exists. {fip}, {port_name}")
+            results[server_name] = server, fip
         else:
-            fip = None
-        return server, fip
+            launches[executor.submit(launch_server, conn, server_name, port_name, image_id, flavor_id, keypair_name, security_group_id, network_id, user_data)] = floating_ip_required
+    booting = {}
+    for future in concurrent.futures.as_completed(launches):
+        server, port = future.result()
+        booting[server.name] = server, port, launches[future]
+    finishing = {
+        executor.submit(finish_server, snapshot, fip_pool, server, *booting[server.name][1:]): server.name
+        for server in ServerWaiter(conn).as_ready(server for server, _, _ in booting.values())
+    }
+    for future in concurrent.futures.as_completed(finishing):
+        results[finishing[future]] = future.result()
+    failed = sorted(set(booting) - set(results))
+    if failed:
+        raise Exception(f"Servers {', '.join(failed)} did not become ACTIVE")
+    return results
 
-def manage_dev_servers(conn, existing_servers, tag_name, image_id, flavor_id, keypair_name, security_group_name, network_id):
+@traced()
+def manage_dev_servers(conn, snapshot, existing_servers, tag_name, required_dev_servers, hosts_file='hosts'):
+    # Returns the IPs of the dev servers that are kept and the ones to create.
     dev_ips = {}
+    to_create = []
     dev_server = f"{tag_name}_dev"
     dev_port_name = f"{tag_name}_dev_port"
-    required_dev_servers = 3
-    devservers_count = len([line for line in existing_servers.splitlines() if dev_server in line])
+    # Dev servers bootstrap themselves through cloud-init, Ansible only applies deltas.
+    user_data = dev_server_user_data()
+    dev_servers = [server for name, server in existing_servers.items() if name.startswith(dev_server)]
+    devservers_count = len(dev_servers)
     print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Will need {required_dev_servers} node, launching them.")        
-    dev_servers = conn.compute.servers(details=True, all_projects=False, filters={"name": f"{dev_server}*"})
     for server in dev_servers:
-        if network_id in server.addresses and server.addresses[network_id]:
-            internal_ip = server.addresses[network_id][0]['addr']
+        internal_ip = get_internal_ip(server.addresses)
+        if internal_ip:
             dev_ips[server.name] = internal_ip
             print(f"Existing server {server.name} with IP {internal_ip} added to dev_ips")
 
     if required_dev_servers > devservers_count:
-        devservers_to_add = required_dev_servers - devservers_count
-        sequence = devservers_count + 1
-        while devservers_to_add > 0:
-            devserver_name = f"{dev_server}{sequence}"
-            dev_port_n = f"{dev_port_name}{sequence}"
-            server, _ = create_servers(conn, devserver_name, dev_port_n, image_id, flavor_id, keypair_name, security_group_name, network_id, False, existing_servers)
-            if network_id in server.addresses and server.addresses[network_id]:
-                internal_ip = server.addresses[network_id][0]['addr']
-                dev_ips[devserver_name] = internal_ip
-            devservers_to_add -= 1
-            sequence += 1
+        # Fills the gaps left by earlier scale-downs first, as operate does.
+        for sequence in free_indexes(dev_servers, dev_server, required_dev_servers - devservers_count):
+            to_create.append((f"{dev_server}{sequence}", f"{dev_port_name}{sequence}", False, user_data))
     elif required_dev_servers < devservers_count:
         devservers_to_remove = devservers_count - required_dev_servers
-        servers = list(conn.compute.servers(details=True, status='ACTIVE', name=f"{tag_name}_dev"))
-        for _ in range(devservers_to_remove):
-            if servers:
-                server_to_delete = servers[0]
-                conn.compute.delete_server(server_to_delete.id)
-                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Deleted {server_to_delete.name} server")
+        # Same victims, drain and deletion wait as operate; the proxies to
+        # drain come from the inventory of the previous run, if there is one.
+        hosts = load_hosts(hosts_file) if os.path.exists(hosts_file) else None
+        for server in remove_dev_servers(conn, tag_name, dev_servers, devservers_to_remove, hosts):
+            snapshot.remove('server', server)
+            dev_ips.pop(server.name, None)
     else:
         print(f"Required number of dev servers({required_dev_servers}) already exist.")
     
-    return dev_ips
+    return dev_ips, to_create
 
-def create_vip_port(conn, network_id, subnet_id, tag_name, server_name, security_group_id, existing_port):
+@traced()
+def create_vip_port(conn, snapshot, network_id, subnet_id, tag_name, server_name, security_group_id):
     vip_port_name = f"{tag_name}_vip_port"
-    existing_port = conn.network.find_port(vip_port_name)
+    existing_port = snapshot.get('port', vip_port_name)
     if existing_port:
         print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} VIP port {vip_port_name} already exists with ID {existing_port.id}.")
         return existing_port
-    vip_port = conn.network.create_port(name=vip_port_name, network_id=network_id,security_groups=[security_group_id])
+    vip_port = snapshot.add('port', conn.network.create_port(name=vip_port_name, network_id=network_id,security_groups=[security_group_id]))
     print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Created VIP port {vip_port_name} with ID {vip_port.id}{security_group_id}.")
     return vip_port
 
-def assign_floating_ip_to_port(conn, vip_port):
+@traced()
+def assign_floating_ip_to_port(conn, snapshot, fip_pool, vip_port):
     if vip_port is None:
         print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} VIP port is None, cannot assign floating IP.")
         return None
-    existing_floating_ips = list(conn.network.ips(port_id=vip_port.id))
+    existing_floating_ips = snapshot.ips_for_port(vip_port.id)
     if existing_floating_ips:
         existing_floating_ip = existing_floating_ips[0]
         print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} VIP port {vip_port.id} already has floating IP {existing_floating_ip.floating_ip_address}.")
         return existing_floating_ip.floating_ip_address, existing_floating_ip.id
-    floating_ip_tuple = create_floating_ip(conn, "ext-net")
-    if floating_ip_tuple[1] is None:
-        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Failed to create floating IP.")
-        return None
-    conn.network.update_ip(floating_ip_tuple[1], port_id=vip_port.id)
-    print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Associated floating IP {floating_ip_tuple[2]} with port {vip_port.id}.")
-    return floating_ip_tuple[2], floating_ip_tuple[1]
+    floating_ip = fip_pool.associate(vip_port.id, snapshot)
+    print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Associated floating IP {floating_ip.floating_ip_address} with port {vip_port.id}.")
+    return floating_ip.floating_ip_address, floating_ip.id
 
-def attach_port_to_server(conn, server_name, vip_port):
-    server_instance = conn.compute.find_server(server_name)
+@traced()
+def attach_port_to_server(conn, snapshot, server_name, vip_port):
+    server_instance = snapshot.find('server', server_name)
     server_interfaces = conn.compute.server_interfaces(server_instance)
     for interface in server_interfaces:
         if interface.port_id == vip_port.id:
@@ -102,12 +124,14 @@ def attach_port_to_server(conn, server_name, vip_port):
     )
     print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Attached VIP port {vip_port.id} to instance {server_instance.name}.")
 
-def generate_vip_addresses_file(vip_floating_ip_haproxy2):
+@traced(kind='file')
+def generate_vip_addresses_file(vip_floating_ip_haproxy2, file_path="vip_address"):
     ip_address, _ = vip_floating_ip_haproxy2
-    with open("vip_address", "w") as f:
+    with open(file_path, "w") as f:
         f.write(f"{ip_address}\n")
     return 
 
+@traced(kind='file')
 def generate_servers_ip_file(server_fip_map, file_path):
     with open(file_path, 'w') as f:
         for server, fip in server_fip_map.items():
@@ -115,28 +139,55 @@ def generate_servers_ip_file(server_fip_map, file_path):
     print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Generated servers_fips file at {file_path}.")
     return file_path
 
-def generate_configs(tag_name, private_key):
+@traced()
+def generate_configs(conn, tag_name, private_key, directory=''):
     print("Genrating Configuration files.")
-    output = run_command(f"python3 scripts/gen_config.py {tag_name} {private_key}")
-    print(output)
-    return output
+    return configfiles.main(tag_name, private_key, conn, directory)
 
+@traced(kind='subprocess')
 def run_ansible_playbook():
     print("Running Ansible playbook...")
     ansible_command = "ansible-playbook -i hosts scripts/site.yaml"
     subprocess.run(ansible_command, shell=True)
 
-def main(rc_file, tag_name, private_key):
+@traced()
+def record_state(conn, tag_name, desired, network_id, subnet_id, vip_port, vip_floating_ip, state_file=state.STATE_FILE):
+    # Read the servers back once so the record holds what the cloud reports,
+    # the VIP included, and the next run can verify against it.
+    servers = {server.name: state.server_record(server) for server in conn.compute.servers(details=True, name=f"^{tag_name}_")}
+    state.update(tag_name, fingerprint=state.fingerprint(desired), servers=servers,
+                 network_id=network_id, subnet_id=subnet_id, vip_port_id=vip_port.id, vip_address=vip_floating_ip[0], file_path=state_file)
+
+@traced('deploy')
+def main(rc_file, tag_name, private_key, conn=None, directory='', dev_servers=None, fip_pool=None):
+    # multideploy.py passes a shared connection and a directory per tag, it
+    # loads credentials itself and gives no rc_file. It also passes one
+    # floating IP pool per project so concurrent tags never take the same address.
     current_date_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     print(f"{current_date_time} Starting deployment of {tag_name} using {rc_file} for credentials.")
     
-    with open(rc_file) as f:
-        for line in f:
-            if line.strip() and not line.startswith('#'):
-                key, value = line.split('=', 1)
-                os.environ[key.strip()] = value.strip()
+    if rc_file:
+        with open(rc_file) as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    key, value = line.split('=', 1)
+                    os.environ[key.strip()] = value.strip()
     
-    conn = connect_to_openstack()
+    conn = conn or connect_to_openstack()
+    required_dev_servers = DEV_SERVERS if dev_servers is None else dev_servers
+    fip_file = os.path.join(directory, "servers_fip")
+    vip_file = os.path.join(directory, "vip_address")
+    state_file = os.path.join(directory, state.STATE_FILE)
+    image_name = "Ubuntu 20.04 Focal Fossa x86_64"
+    flavor_name = "1C-2GB-50GB"
+    desired = {'dev_servers': required_dev_servers, 'image': image_name, 'flavor': flavor_name,
+               'public_key': extract_public_key(private_key), 'user_data': state.fingerprint(dev_server_user_data())}
+    with span('converged check'):
+        if state.converged(conn, tag_name, desired, files=(fip_file, vip_file, os.path.join(directory, "hosts"), os.path.join(directory, "ansible.cfg")), file_path=state_file):
+            print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Deployment of {tag_name} is already converged, nothing to do.")
+            return
+    with span('snapshot'):
+        snapshot = ResourceSnapshot(conn, tag_name)
     network_name = f"{tag_name}_network"
     subnet_name = f"{tag_name}_subnet"
     router_name = f"{tag_name}_router"
@@ -151,24 +202,35 @@ def main(rc_file, tag_name, private_key):
     
 
     create_keypair(conn, keypair_name, private_key)
-    network_id, subnet_id = setup_network(conn, tag_name, network_name, subnet_name, router_name, security_group_name)   
-    uuids = fetch_server_uuids(conn, "Ubuntu 20.04 Focal Fossa x86_64", "1C-2GB-50GB",security_group_name)
-    existing_servers, _ = run_command("openstack server list --status ACTIVE --column Name -f value")
-    bastion_server, bastion_fip = create_servers(conn,bastion_name,bastion_port_name,uuids['image_id'],uuids['flavor_id'],keypair_name,uuids['security_group_id'],network_id,True,existing_servers)
-    haproxy_server, haproxy_fip = create_servers(conn, haproxy_name, haproxy_port_name, uuids['image_id'],uuids['flavor_id'],keypair_name,uuids['security_group_id'],network_id,True,existing_servers)
-    haproxy2_server, haproxy2_fip = create_servers(conn, haproxy2_name, haproxy2_port_name, uuids['image_id'],uuids['flavor_id'],keypair_name,uuids['security_group_id'],network_id,True,existing_servers)
-    fip_map = {
-        bastion_name: bastion_fip,
-        haproxy_name: haproxy_fip,
-        haproxy2_name: haproxy2_fip
-    }    
-    generate_servers_ip_file(fip_map, "servers_fip")
-    manage_dev_servers(conn, existing_servers, tag_name, uuids['image_id'], uuids['flavor_id'], keypair_name, uuids["security_group_id"], network_id)
-    existing_ports = conn.network.ports()
-    vip_port_haproxy2 = create_vip_port(conn, network_id, subnet_id, tag_name, haproxy2_server.id,uuids["security_group_id"] ,existing_ports)
-    attach_port_to_server(conn, haproxy2_server.id, vip_port_haproxy2)
-    vip_floating_ip_haproxy2 = assign_floating_ip_to_port(conn, vip_port_haproxy2)
-    generate_vip_addresses_file(vip_floating_ip_haproxy2)
+    network_id, subnet_id = setup_network(conn, snapshot, tag_name, network_name, subnet_name, router_name, security_group_name)   
+    uuids = fetch_server_uuids(conn, snapshot, image_name, flavor_name,security_group_name)
+    existing_servers = {server.name: server for server in snapshot.with_prefix('server', f"{tag_name}_") if server.status == 'ACTIVE'}
+    public_servers = [(bastion_name, bastion_port_name), (haproxy_name, haproxy_port_name), (haproxy2_name, haproxy2_port_name)]
+    # Allocate every address this deploy still needs (public nodes plus the VIP) in one batch up front.
+    fip_pool = fip_pool or FloatingIPPool(conn, snapshot)
+    fip_pool.fill(len([server_name for server_name, _ in public_servers if server_name not in existing_servers]) + (0 if snapshot.get('port', f"{tag_name}_vip_port") else 1))
+    # Boot the public nodes and the dev servers together so the deploy waits for one boot, not one per server.
+    dev_ips, dev_servers = manage_dev_servers(conn, snapshot, existing_servers, tag_name, required_dev_servers, os.path.join(directory, "hosts"))
+    with span('provision servers'), concurrent.futures.ThreadPoolExecutor(max_workers=PROVISION_WORKERS) as executor:
+        results = create_servers(conn, snapshot, fip_pool, [(server_name, port_name, True, None) for server_name, port_name in public_servers] + dev_servers,
+                                 uuids['image_id'], uuids['flavor_id'], keypair_name, uuids['security_group_id'], network_id, existing_servers, executor)
+    for server_name, _, _, _ in dev_servers:
+        internal_ip = get_internal_ip(results[server_name][0].addresses)
+        if internal_ip:
+            dev_ips[server_name] = internal_ip
+    public_results = {server_name: results[server_name] for server_name, _ in public_servers}
+    haproxy2_server = public_results[haproxy2_name][0]
+    fip_map = {server_name: public_results[server_name][1] for server_name, _ in public_servers}
+    generate_servers_ip_file(fip_map, fip_file)
+    print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Dev servers: {dev_ips}")
+    vip_port_haproxy2 = create_vip_port(conn, snapshot, network_id, subnet_id, tag_name, haproxy2_server.id,uuids["security_group_id"])
+    attach_port_to_server(conn, snapshot, haproxy2_server.id, vip_port_haproxy2)
+    vip_floating_ip_haproxy2 = assign_floating_ip_to_port(conn, snapshot, fip_pool, vip_port_haproxy2)
+    generate_vip_addresses_file(vip_floating_ip_haproxy2, vip_file)
+    invalidate_inventory_cache(os.path.join(directory, INVENTORY_CACHE_FILE))
+    # Same connection and token as the deploy, no second interpreter or login.
+    generate_configs(conn, tag_name, private_key, directory)
+    record_state(conn, tag_name, desired, network_id, subnet_id, vip_port_haproxy2, vip_floating_ip_haproxy2, state_file)
     print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Deployment of {tag_name} completed.")
 
 if __name__ == "__main__":
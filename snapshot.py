@@ -0,0 +1,121 @@
+import threading
+
+KINDS = ('server', 'port', 'ip', 'network', 'subnet', 'router', 'security_group')
+
+class ResourceSnapshot:
+    # Lists every resource type of a tag once and answers the per-name lookups
+    # of a deploy or cleanup run from memory. Callers keep it current through
+    # add()/remove() as they create and delete resources.
+
+    def __init__(self, conn, tag_name, external_network='ext-net'):
+        self.conn = conn
+        self.tag_name = tag_name
+        self.external_network = external_network
+        self.lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self):
+        conn = self.conn
+        tag_name = self.tag_name
+        project_id = conn.current_project_id
+        with self.lock:
+            self.by_id = {kind: {} for kind in KINDS}
+            self.by_name = {kind: {} for kind in KINDS}
+            self.ports_by_device = {}
+            self.ports_by_subnet = {}
+            self.ips_by_address = {}
+            self.ips_by_port = {}
+
+            for server in conn.compute.servers(details=True, name=f"^{tag_name}_"):
+                self.add('server', server)
+            for network in conn.network.networks(name=f"{tag_name}_network"):
+                self.add('network', network)
+            for network in conn.network.networks(name=self.external_network):
+                self.add('network', network)
+            for subnet in conn.network.subnets(name=f"{tag_name}_subnet"):
+                self.add('subnet', subnet)
+            for router in conn.network.routers(name=f"{tag_name}_router"):
+                self.add('router', router)
+            for security_group in conn.network.security_groups(name=f"{tag_name}_security_group", project_id=project_id):
+                self.add('security_group', security_group)
+            network = self.get('network', f"{tag_name}_network")
+            if network:
+                for port in conn.network.ports(network_id=network.id):
+                    self.add('port', port)
+            for floating_ip in conn.network.ips(project_id=project_id):
+                self.add('ip', floating_ip)
+
+    def add(self, kind, resource):
+        with self.lock:
+            self.by_id[kind][resource.id] = resource
+            if resource.name:
+                self.by_name[kind].setdefault(resource.name, {})[resource.id] = resource
+            if kind == 'port':
+                if resource.device_id:
+                    self.ports_by_device.setdefault(resource.device_id, {})[resource.id] = resource
+                for fixed_ip in resource.fixed_ips or []:
+                    self.ports_by_subnet.setdefault(fixed_ip['subnet_id'], {})[resource.id] = resource
+            elif kind == 'ip':
+                self.ips_by_address[resource.floating_ip_address] = resource
+                if resource.port_id:
+                    self.ips_by_port.setdefault(resource.port_id, {})[resource.id] = resource
+        return resource
+
+    def remove(self, kind, resource):
+        with self.lock:
+            self.by_id[kind].pop(resource.id, None)
+            self.by_name[kind].get(resource.name, {}).pop(resource.id, None)
+            if kind == 'port':
+                self.ports_by_device.get(resource.device_id, {}).pop(resource.id, None)
+                for fixed_ip in resource.fixed_ips or []:
+                    self.ports_by_subnet.get(fixed_ip['subnet_id'], {}).pop(resource.id, None)
+            elif kind == 'ip':
+                self.ips_by_address.pop(resource.floating_ip_address, None)
+                self.ips_by_port.get(resource.port_id, {}).pop(resource.id, None)
+
+    def update(self, kind, resource):
+        with self.lock:
+            old = self.by_id[kind].get(resource.id)
+            if old is not None:
+                self.remove(kind, old)
+            return self.add(kind, resource)
+
+    def get(self, kind, name):
+        with self.lock:
+            matches = list(self.by_name[kind].get(name, {}).values())
+        return matches[0] if matches else None
+
+    def get_by_id(self, kind, resource_id):
+        with self.lock:
+            return self.by_id[kind].get(resource_id)
+
+    def find(self, kind, name_or_id):
+        return self.get_by_id(kind, name_or_id) or self.get(kind, name_or_id)
+
+    def named(self, kind, name):
+        with self.lock:
+            return list(self.by_name[kind].get(name, {}).values())
+
+    def with_prefix(self, kind, prefix):
+        with self.lock:
+            return sorted((resource for resource in self.by_id[kind].values() if resource.name and resource.name.startswith(prefix)), key=lambda resource: resource.name)
+
+    def all(self, kind):
+        with self.lock:
+            return list(self.by_id[kind].values())
+
+    def ports_for_device(self, device_id):
+        with self.lock:
+            return list(self.ports_by_device.get(device_id, {}).values())
+
+    def ports_on_subnet(self, subnet_id):
+        with self.lock:
+            return list(self.ports_by_subnet.get(subnet_id, {}).values())
+
+    def ip_for_address(self, address):
+        with self.lock:
+            return self.ips_by_address.get(address)
+
+    def ips_for_port(self, port_id):
+        with self.lock:
+            return list(self.ips_by_port.get(port_id, {}).values())
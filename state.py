@@ -0,0 +1,97 @@
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import threading
+import contextlib
+
+# One JSON document holds a record per tag: the IDs and addresses a deploy
+# created and a fingerprint of what it was asked to build. A re-run compares
+# the fingerprint and checks the record against a single server listing
+# instead of rediscovering every resource by name.
+
+STATE_FILE = os.getenv('DEPLOY_STATE_FILE', '.deploy_state.json')
+
+_lock = threading.Lock()
+
+def fingerprint(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+@contextlib.contextmanager
+def locked(file_path=STATE_FILE):
+    # Threads of this process and other processes (install, operate) update
+    # the document one at a time.
+    with _lock, open(f"{file_path}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def load(file_path=STATE_FILE):
+    try:
+        with open(file_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def write(document, file_path=STATE_FILE):
+    directory = os.path.dirname(file_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(file_path)}.")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def get(tag_name, file_path=STATE_FILE):
+    return load(file_path).get(tag_name)
+
+def update(tag_name, file_path=STATE_FILE, **fields):
+    # Merges fields into the tag's record, None drops a field.
+    with locked(file_path):
+        document = load(file_path)
+        record = document.setdefault(tag_name, {})
+        for key, value in fields.items():
+            if value is None:
+                record.pop(key, None)
+            else:
+                record[key] = value
+        write(document, file_path)
+        return record
+
+def forget(tag_name, file_path=STATE_FILE):
+    with locked(file_path):
+        document = load(file_path)
+        if document.pop(tag_name, None) is not None:
+            write(document, file_path)
+
+def server_record(server, floating_ip=None):
+    addresses = [address['addr'] for address_list in (server.addresses or {}).values() for address in address_list]
+    return {'id': server.id, 'addresses': sorted(set(addresses) | ({floating_ip} if floating_ip else set()))}
+
+def converged(conn, tag_name, desired, files=(), file_path=STATE_FILE):
+    # True if the tag was last deployed with the same desired state and every
+    # recorded server is still there, ACTIVE, with its addresses. Costs one
+    # list call, or none when the record cannot match anyway.
+    record = get(tag_name, file_path)
+    if not record or record.get('fingerprint') != fingerprint(desired):
+        return False
+    if not all(os.path.exists(path) for path in files):
+        return False
+    recorded = record.get('servers', {})
+    servers = {server.name: server for server in conn.compute.servers(details=True, name=f"^{tag_name}_")}
+    if set(servers) != set(recorded):
+        return False
+    for name, expected in recorded.items():
+        server = servers[name]
+        if server.id != expected['id'] or server.status != 'ACTIVE':
+            return False
+        if not set(expected['addresses']) <= set(server_record(server)['addresses']):
+            return False
+    return True
@@ -0,0 +1,81 @@
+import os
+import json
+import stat
+import datetime
+import tempfile
+import openstack
+
+# Keystone tokens outlive a single script. install, operate, cleanup and the
+# dynamic inventory each used to authenticate from scratch; this keeps the
+# token (and the catalog that comes with it) on disk, readable only by the
+# user, and hands it to the next process's auth plugin. Once the token is
+# close to expiry the plugin simply authenticates again and the new token
+# replaces it.
+
+TOKEN_CACHE_FILE = os.getenv('TOKEN_CACHE_FILE', os.path.expanduser('~/.cache/nso/tokens.json'))
+# Tokens expiring within this many seconds are not handed out
+TOKEN_CACHE_MARGIN = int(os.getenv('TOKEN_CACHE_MARGIN', '300'))
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def load(file_path=TOKEN_CACHE_FILE):
+    # Ignores a cache that other users could read or write.
+    try:
+        info = os.stat(file_path)
+        if info.st_uid != os.getuid() or info.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+            return {}
+        with open(file_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save(entries, file_path=TOKEN_CACHE_FILE):
+    directory = os.path.dirname(file_path) or '.'
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    # mkstemp creates the file with mode 0600
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(file_path)}.")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def fresh(entry, margin=TOKEN_CACHE_MARGIN):
+    try:
+        expires_at = datetime.datetime.fromisoformat(entry['expires_at'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return expires_at - now() > datetime.timedelta(seconds=margin)
+
+def store(auth, cache_id, file_path=TOKEN_CACHE_FILE):
+    state = auth.get_auth_state()
+    if not state or auth.auth_ref is None or auth.auth_ref.expires is None:
+        return
+    entries = {key: entry for key, entry in load(file_path).items() if fresh(entry, 0)}
+    entries[cache_id] = {'state': state, 'expires_at': auth.auth_ref.expires.isoformat()}
+    try:
+        save(entries, file_path)
+    except OSError as e:
+        print(f"Could not write the token cache {file_path}: {e}")
+
+def connect(file_path=TOKEN_CACHE_FILE, margin=TOKEN_CACHE_MARGIN, **kwargs):
+    # openstack.connect() with the token cache in front of Keystone.
+    # Connections without a cacheable auth plugin are returned unchanged.
+    conn = openstack.connect(**kwargs)
+    auth = getattr(getattr(conn, 'session', None), 'auth', None)
+    try:
+        cache_id = auth.get_cache_id() if auth is not None else None
+    except NotImplementedError:
+        cache_id = None
+    if not cache_id:
+        return conn
+    entry = load(file_path).get(cache_id)
+    if entry and fresh(entry, margin):
+        auth.set_auth_state(entry['state'])
+    else:
+        conn.authorize()
+        store(auth, cache_id, file_path)
+    return conn
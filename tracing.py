@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import types
+import atexit
+import datetime
+import itertools
+import threading
+import functools
+import contextlib
+import collections
+
+# Span records are only written when TRACE_FILE names a file, the summary
+# at exit is printed either way.
+TRACE_FILE = os.getenv('TRACE_FILE', '')
+SUMMARY_TOP = int(os.getenv('TRACE_SUMMARY_TOP', '10'))
+
+RUN_ID = f"{os.path.basename(sys.argv[0] or 'python')}-{os.getpid()}-{int(time.time())}"
+
+_local = threading.local()
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_trace_file = None
+
+# name -> [count, total seconds, max seconds], and kind per name
+TOTALS = collections.defaultdict(lambda: [0, 0.0, 0.0])
+KINDS = {}
+API_CALLS = collections.Counter()
+
+def _emit(record):
+    global _trace_file
+    if not TRACE_FILE:
+        return
+    line = json.dumps(record, default=str) + "\n"
+    with _lock:
+        if _trace_file is None:
+            _trace_file = open(TRACE_FILE, 'a', buffering=1)
+        _trace_file.write(line)
+
+def current_span():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+@contextlib.contextmanager
+def span(name, kind='phase', parent=None, **attributes):
+    # Spans nest per thread. Work handed to a pool can pass parent=current_span()
+    # from the submitting thread to keep the tree connected.
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    span_id = next(_ids)
+    parent_id = stack[-1] if stack else parent
+    stack.append(span_id)
+    started = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield span_id
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stack.pop()
+        with _lock:
+            totals = TOTALS[name]
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] = max(totals[2], duration)
+            KINDS[name] = kind
+            if kind in ('api', 'wait') and '.' in name:
+                API_CALLS[name] += 1
+        record = {
+            'run': RUN_ID,
+            'id': span_id,
+            'parent': parent_id,
+            'name': name,
+            'kind': kind,
+            'start': datetime.datetime.fromtimestamp(started).isoformat(timespec='milliseconds'),
+            'duration_ms': round(duration * 1000, 3),
+            'thread': threading.current_thread().name,
+        }
+        if attributes:
+            record['attributes'] = attributes
+        if error:
+            record['error'] = error
+        _emit(record)
+
+def traced(name=None, kind='phase'):
+    def decorator(function):
+        span_name = name or function.__name__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name, kind):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class TracedProxy:
+    # Wraps an SDK service proxy (conn.compute, conn.network) so every call is
+    # a span. Generators are drained inside the span, otherwise the paginated
+    # requests would run after the span has already ended.
+
+    def __init__(self, proxy, service):
+        self._proxy = proxy
+        self._service = service
+
+    def __getattr__(self, attribute):
+        value = getattr(self._proxy, attribute)
+        if attribute.startswith('_') or not callable(value):
+            return value
+        kind = 'wait' if attribute.startswith('wait_for') else 'api'
+        span_name = f"{self._service}.{attribute}"
+
+        @functools.wraps(value)
+        def call(*args, **kwargs):
+            with span(span_name, kind):
+                result = value(*args, **kwargs)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+                return result
+        return call
+
+class TracedConnection:
+    def __init__(self, conn):
+        self._conn = conn
+        self.compute = TracedProxy(conn.compute, 'compute')
+        self.network = TracedProxy(conn.network, 'network')
+
+    def __getattr__(self, attribute):
+        return getattr(self._conn, attribute)
+
+def trace_connection(conn):
+    return conn if isinstance(conn, TracedConnection) else TracedConnection(conn)
+
+def summary(top=SUMMARY_TOP):
+    with _lock:
+        totals = {name: list(values) for name, values in TOTALS.items()}
+        api_calls = dict(API_CALLS)
+        kinds = dict(KINDS)
+    if not totals:
+        return ""
+    lines = [f"Slowest phases ({RUN_ID}):"]
+    phases = sorted(((values[1], name) for name, values in totals.items() if kinds[name] != 'api'), reverse=True)
+    for total, name in phases[:top]:
+        count, _, longest = totals[name]
+        lines.append(f"  {total:9.2f}s  {name} [{kinds[name]}] x{count}, max {longest:.2f}s")
+    if api_calls:
+        lines.append(f"OpenStack API calls: {sum(api_calls.values())}")
+        for name, count in sorted(api_calls.items(), key=lambda item: (-item[1], item[0])):
+            lines.append(f"  {count:6d}  {name}  {totals[name][1]:.2f}s")
+    return "\n".join(lines)
+
+@atexit.register
+def print_summary():
+    text = summary()
+    if text:
+        print(text, file=sys.stderr)
@@ -0,0 +1,140 @@
+import os
+import re
+import time
+import random
+import datetime
+import threading
+import openstack.exceptions
+from tracing import span
+
+WAIT_TIMEOUT = int(os.getenv('SERVER_WAIT_TIMEOUT', '600'))
+INITIAL_DELAY = 1
+MAX_DELAY = 15
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{timestamp} {message}")
+
+def is_active(server):
+    return server.status == 'ACTIVE'
+
+def is_network_ready(server):
+    return server.status == 'ACTIVE' and bool(server.addresses)
+
+class ServerWaiter:
+    # Tracks every server still booting and polls them all with one filtered
+    # list call per tick. Threads that each create a server call wait(); a
+    # single caller can iterate as_ready() instead. The delay doubles while
+    # nothing changes and drops back once a server comes up, since servers
+    # booted together tend to finish together.
+
+    def __init__(self, conn, ready=is_active, initial_delay=INITIAL_DELAY, max_delay=MAX_DELAY):
+        self.conn = conn
+        self.ready = ready
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.delay = initial_delay
+        self.condition = threading.Condition()
+        # name -> server id (None when only the name is known)
+        self.pending = {}
+        self.done = {}
+        self.failed = {}
+        self.polling = False
+        self.next_poll = 0
+
+    def add(self, server):
+        name, server_id = (server, None) if isinstance(server, str) else (server.name, server.id)
+        with self.condition:
+            self.pending[name] = server_id
+            self.done.pop(name, None)
+            self.failed.pop(name, None)
+        return name
+
+    def poll(self):
+        with self.condition:
+            pending = dict(self.pending)
+        if not pending:
+            return
+        name_filter = "^(" + "|".join(re.escape(name) for name in sorted(pending)) + ")$"
+        with span('poll servers', 'wait', pending=len(pending)):
+            servers = list(self.conn.compute.servers(details=True, name=name_filter))
+        progress = False
+        with self.condition:
+            for server in servers:
+                if server.name not in self.pending or self.pending[server.name] not in (None, server.id):
+                    continue
+                if self.ready(server):
+                    self.done[server.name] = server
+                elif server.status == 'ERROR':
+                    self.failed[server.name] = server
+                else:
+                    continue
+                del self.pending[server.name]
+                progress = True
+            self.delay = self.initial_delay if progress else min(self.delay * 2, self.max_delay)
+            # Jitter keeps several waiters from polling the API in lockstep.
+            self.next_poll = time.monotonic() + random.uniform(self.delay / 2, self.delay)
+            self.condition.notify_all()
+
+    def result(self, name):
+        # The ready server, None while pending; raises if it failed.
+        if name in self.failed:
+            server = self.failed.pop(name)
+            raise openstack.exceptions.ResourceFailure(f"Server {name} went to {server.status}")
+        return self.done.pop(name, None)
+
+    def step(self, deadline):
+        # Polls if a poll is due and nobody else is polling, otherwise sleeps
+        # until the next poll or the deadline.
+        with self.condition:
+            now = time.monotonic()
+            if self.polling or now < self.next_poll:
+                self.condition.wait(max(0.0, min(self.next_poll, deadline) - now) or 0.05)
+                return
+            self.polling = True
+        try:
+            self.poll()
+        finally:
+            with self.condition:
+                self.polling = False
+                self.condition.notify_all()
+
+    def wait(self, server, timeout=WAIT_TIMEOUT):
+        name = self.add(server)
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.condition:
+                ready = self.result(name)
+                if ready is not None:
+                    return ready
+                if time.monotonic() >= deadline:
+                    self.pending.pop(name, None)
+                    raise openstack.exceptions.ResourceTimeout(f"Timed out after {timeout}s waiting for server {name}")
+            self.step(deadline)
+
+    def as_ready(self, servers, timeout=WAIT_TIMEOUT):
+        # Yields each server as soon as it is ready. Servers still pending at
+        # the deadline, or that went to ERROR, are logged and left out.
+        names = {self.add(server) for server in servers}
+        deadline = time.monotonic() + timeout
+        while names:
+            with self.condition:
+                finished = [name for name in names if name in self.done or name in self.failed]
+            for name in finished:
+                names.discard(name)
+                try:
+                    with self.condition:
+                        server = self.result(name)
+                except openstack.exceptions.ResourceFailure as e:
+                    log(str(e))
+                    continue
+                yield server
+            if not names:
+                break
+            if time.monotonic() >= deadline:
+                with self.condition:
+                    for name in names:
+                        self.pending.pop(name, None)
+                log(f"Timed out after {timeout}s waiting for {', '.join(sorted(names))}")
+                break
+            self.step(deadline)